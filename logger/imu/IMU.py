@@ -1,39 +1,99 @@
 import time
-import smbus
-bus = smbus.SMBus(1)
 
+from sensors import bus as buses
+from sensors import arbiter
 from sensors import sensor
+from sensors import calibration
+from sensors import sampler
+from sensors import altitude
+from sensors import clock
+from storage import rotation
+from storage import writer
 import bluetooth
 
-imu = sensor.IMU(bus)
-thm = sensor.Thermometer(bus)
-bar = sensor.Barometer(bus)
-alt = sensor.Altimeter(bus)
+bus = None
+imu = None
+bmp = None
+thm = None
+bar = None
+alt = None
+store = None
+busSpec = None
+
+def setup(spec, calibrationPath=calibration.DEFAULT_PATH, pressureProfile="standard", pressureForced=False,
+          seaLevel=altitude.SEA_LEVEL):
+    global bus, imu, bmp, thm, bar, alt, store, busSpec
+    busSpec = spec
+    # Shared with the BLE callbacks, so every transaction goes through the arbiter
+    bus = arbiter.BusArbiter(buses.connect(spec))
+    imu = sensor.IMU(bus)
+    imu.mag.key = calibration.key(spec, imu.mag.address)
+    store = calibration.Store(calibrationPath)
+    bmp = sensor.Pressure(bus, 0x77, pressureProfile, pressureForced)
+    thm = sensor.Thermometer(bmp)
+    bar = sensor.Barometer(bmp)
+    alt = sensor.Altimeter(bmp, seaLevel)
 
 def detect():
-    global imu, thm, bar, alt
+    global imu, bmp
     try:
         imu.detect()
-        thm.detect()
-        bar.detect()
-        alt.detect()
+        bmp.detect()
     except sensor.SensorError as e:
         print("Could not detect %s\n" % e.name)
         return False
     else:
         return True
 
-def initialize():
-    global imu, thm, bar, alt
-    imu.initialize()
-    thm.initialize()
-    bar.initialize()
-    alt.initialize()
+def initialize(rate, recalibrate=False, logPath=None, logOptions={}, sampling=sampler.Sampler.ODR):
+    global imu, bmp
+    imu.initialize(store, recalibrate)
+    bmp.initialize()
+
+    # Logging needs the sampler, so it overrides reading on demand
+    if logPath is not None and rate == 0:
+        print("Logging reads each sensor at its output data rate\n")
+        rate = None
+
+    # No rate reads each sensor at its own output data rate, 0 reads the bus on demand
+    if rate is None or rate > 0:
+        # Log writes go through a queue to their own thread, so a slow card can't stall the sampler.
+        # Rotating or compressing the log splits it into segments.
+        log = None
+        if logPath is not None and "maxBytes" in logOptions:
+            log = rotation.RotatingWriter(logPath, logMetadata(), **logOptions)
+            if log.codec != logOptions["compression"] and logOptions["compression"] != "none":
+                print("%s not found, compressing with %s\n" % (logOptions["compression"], log.codec or "nothing"))
+        elif logPath is not None:
+            log = writer.BackgroundWriter(logPath, logMetadata(), **logOptions)
+        imu.startSampler(rate, pressure=bmp, log=log, mode=sampling)
 
     bluetooth.init(imu)
 
     return
 
+def logMetadata():
+    # Everything needed to turn the raw values in a log back into units
+    registers = {}
+    for device in [imu.gyr, imu.mag, bmp]:
+        registers["0x%02X" % device.address] = dict(("0x%02X" % r, v) for r, v in sorted(device.shadow().items()))
+    return {
+        "bus": busSpec,
+        "startTime": time.time(),
+        "startMonotonic": clock.monotonic_ns(),
+        "registers": registers,
+        "odr": {"gyro": imu.gyr.odr(), "mag": imu.mag.odr(), "pressure": 1 / bmp.period()},
+        "gyroGain": sensor.Gyroscope.GAIN,
+        "calibration": {"key": imu.mag.key,
+                        "profile": imu.mag.profile.toDict() if imu.mag.profile is not None else None},
+        "pressure": {"address": bmp.address, "trim": list(bmp.trim), "forced": bmp.forced},
+    }
+
+def close():
+    # Stops the sampler, which also closes the log
+    if imu is not None:
+        imu.stopSampler()
+
 def printData():
     global imu, thm, bar, alt
     print(imu)
@@ -6,7 +6,16 @@ from os import path, system
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
 import time
+import argparse
 from imu import IMU
+from sensors import stats
+from sensors import calibration
+from sensors import sensor
+from sensors import sampler
+from sensors import scheduler
+from storage import binlog
+from storage import rotation
+from storage import writer
 
 def loop():
     system('clear')
@@ -14,16 +23,79 @@ def loop():
     return
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bus", default="smbus:1",
+                        help="smbus:<n>, smbus2:<n>, record:<n>:<file>, replay:<file>[:<hz>[:<s>]] or sim[:<hz>[:<s>]]")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="background accel/gyro sample rate in Hz, by default each sensor's configured "
+                             "output data rate, 0 reads the bus on demand")
+    parser.add_argument("--sampling", default=sampler.Sampler.ODR, choices=sampler.Sampler.MODES,
+                        help="read accel/gyro on a timer at the output data rate, drain the hardware FIFO, "
+                             "or poll the status registers for new data")
+    parser.add_argument("--stats", action="store_true",
+                        help="count I2C transactions per device and print them on exit")
+    parser.add_argument("--calibration", default=calibration.DEFAULT_PATH,
+                        help="magnetometer calibration profile file")
+    parser.add_argument("--calibrate", action="store_true",
+                        help="recalibrate the magnetometer even if a stored profile exists")
+    parser.add_argument("--pressure-profile", default="standard", choices=sorted(sensor.Pressure.PROFILES),
+                        help="BMP280 oversampling and filter profile")
+    parser.add_argument("--pressure-forced", action="store_true",
+                        help="convert pressure on demand instead of continuously")
+    parser.add_argument("--sea-level", type=float, default=1013.25,
+                        help="sea level pressure in hPa, the reference for altitude")
+    parser.add_argument("--log", default=None,
+                        help="write every sample to this binary log file")
+    parser.add_argument("--log-queue", type=int, default=64,
+                        help="blocks of %d samples the log queue holds while the card is busy" % binlog.RECORDS_PER_BLOCK)
+    parser.add_argument("--log-overflow", default=writer.BackgroundWriter.DROP_OLDEST,
+                        choices=writer.BackgroundWriter.POLICIES,
+                        help="what to do with a block when the log queue is full")
+    parser.add_argument("--log-fsync", type=float, default=1.0,
+                        help="seconds between fsyncs of the log, 0 syncs every write, negative leaves it to the OS")
+    parser.add_argument("--log-rotate-size", type=float, default=0,
+                        help="start a new log segment after this many MB, 0 for no limit")
+    parser.add_argument("--log-rotate-time", type=float, default=0,
+                        help="start a new log segment after this many seconds, 0 for no limit")
+    parser.add_argument("--log-compress", default="none", choices=["none"] + sorted(rotation.CODECS),
+                        help="compress closed log segments in a separate process")
+    parser.add_argument("--log-stream", action="store_true",
+                        help="compress the active log segment as it is written, with --log-compress")
+    args = parser.parse_args()
+
+    if args.stats:
+        stats.enable()
+
+    # Refresh the display every 250 ms, dropping refreshes that fall behind
+    display = scheduler.Scheduler(0.25, scheduler.Scheduler.SKIP)
+
     try:
+        IMU.setup(args.bus, args.calibration, args.pressure_profile, args.pressure_forced,
+                  args.sea_level * 100)
         if IMU.detect():
-            IMU.initialize()
+            logOptions = {"capacity": args.log_queue, "policy": args.log_overflow,
+                          "fsyncInterval": args.log_fsync if args.log_fsync >= 0 else None}
+            if args.log_rotate_size or args.log_rotate_time or args.log_compress != "none":
+                logOptions.update({"maxBytes": int(args.log_rotate_size * 1024 * 1024),
+                                   "maxSeconds": args.log_rotate_time, "compression": args.log_compress,
+                                   "streaming": args.log_stream})
+            IMU.initialize(args.rate, args.calibrate, args.log, logOptions, args.sampling)
             time.sleep(1)
 
             while True:
+                display.wait()
                 loop()
-                time.sleep(0.25)
     except KeyboardInterrupt:
         print("\nExiting...")
+        # os._exit below skips atexit handlers, so dump the counters here
+        if args.stats:
+            stats.report()
+            sys.stderr.write("Display loop\t" + str(display))
+            if IMU.imu is not None and IMU.imu.sampler is not None:
+                sys.stderr.write(str(IMU.imu.sampler))
+                if IMU.imu.sampler.log is not None:
+                    sys.stderr.write(str(IMU.imu.sampler.log))
+        IMU.close()
         try:
             sys.exit(0)
         except SystemExit:
@@ -0,0 +1,62 @@
+# Barometric altitude and vertical speed, for live readings and whole logs alike
+
+# Standard sea level pressure in Pa
+SEA_LEVEL = 101325.0
+
+# Exponent of the barometric formula, 1 / 5.257
+EXPONENT = 1 / 5.257
+
+# Temperature lapse rate in K/m
+LAPSE_RATE = 0.0065
+
+def altitude(pressure, temperature, seaLevel=SEA_LEVEL):
+    # Height in metres above the seaLevel reference, from pressure in Pa and temperature in degrees C.
+    # Works on plain numbers and element-wise on NumPy arrays.
+    return ((seaLevel / pressure) ** EXPONENT - 1) * (temperature + 273.15) / LAPSE_RATE
+
+def altitudes(pressures, temperatures, seaLevel=SEA_LEVEL):
+    # altitude() for sequences of samples in one vectorized pass. Needs NumPy.
+    import numpy as np
+    return altitude(np.asarray(pressures, dtype=np.float64), np.asarray(temperatures, dtype=np.float64), seaLevel)
+
+def seaLevelPressure(pressure, temperature, knownAltitude):
+    # The sea level reference that makes altitude() return knownAltitude, e.g. a field elevation
+    return pressure * (knownAltitude * LAPSE_RATE / (temperature + 273.15) + 1) ** (1 / EXPONENT)
+
+class VerticalSpeed():
+    # Streaming alpha-beta filter over altitude samples: tracks a smoothed altitude and its rate of change.
+    # Smaller alpha and beta smooth more and respond later. Samples may arrive at any interval.
+
+    def __init__(self, alpha=0.2, beta=0.02):
+        self.alpha = alpha
+        self.beta = beta
+        self.altitude = None
+        self.speed = 0.0
+        self.time = None
+
+    def update(self, time, altitude):
+        # time in seconds, altitude in metres. Returns the vertical speed in m/s.
+        if self.altitude is None:
+            self.altitude = altitude
+            self.time = time
+            return self.speed
+
+        dt = time - self.time
+        if dt <= 0:
+            return self.speed
+        self.time = time
+
+        predicted = self.altitude + self.speed * dt
+        residual = altitude - predicted
+        self.altitude = predicted + self.alpha * residual
+        self.speed += self.beta * residual / dt
+        return self.speed
+
+    def run(self, times, altitudes):
+        # Filters a whole recording, returns the vertical speed after each sample
+        return [self.update(time, altitude) for time, altitude in zip(times, altitudes)]
+
+    def reset(self):
+        self.altitude = None
+        self.speed = 0.0
+        self.time = None
@@ -0,0 +1,182 @@
+import threading
+
+from sensors import bus as buses
+
+class Request():
+    def __init__(self, operation, args, addresses):
+        self.operation = operation
+        self.args = args
+        self.addresses = addresses
+        self.thread = threading.current_thread()
+        self.done = False
+        self.result = None
+        self.error = None
+
+    def get(self):
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class NoLock():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+class DeviceLock():
+    def __init__(self, arbiter, address):
+        self.arbiter = arbiter
+        self.address = address
+
+    def __enter__(self):
+        self.arbiter.acquire(self.address)
+        return self
+
+    def __exit__(self, *args):
+        self.arbiter.release(self.address)
+        return False
+
+class BusArbiter():
+    # Shares one bus between threads, e.g. the sampling loop and the BLE D-Bus callbacks.
+    #
+    # Transactions from all consumers go through one queue. Whichever thread finds the bus idle runs every
+    # queued request as a batch while the others wait, and identical reads queued in the same batch are
+    # served by a single transaction. A thread that holds device(address) runs a multi-transaction sequence
+    # (FIFO drain, status then data) while transactions from other threads to that device wait for it.
+
+    READS = ["read_byte_data", "read_i2c_block_data", "read_blocks"]
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.condition = threading.Condition()
+        self.queue = []
+        self.busy = False
+        self.owners = {}
+        self.batches = 0
+        self.transactions = 0
+        self.coalesced = 0
+
+    def device(self, address):
+        return DeviceLock(self, address)
+
+    def heldElsewhere(self, addresses):
+        # Called with the condition held. True while another thread holds any of the devices.
+        current = threading.current_thread()
+        return any(address in self.owners and self.owners[address][0] != current for address in addresses)
+
+    def waitDevice(self, address):
+        # Called with the condition held
+        while self.heldElsewhere([address]):
+            self.condition.wait()
+        return self.owners.get(address)
+
+    def acquire(self, address):
+        with self.condition:
+            owner = self.waitDevice(address)
+            # Let transactions other threads already queued for this device finish before the sequence starts
+            while any(address in r.addresses and r.thread != threading.current_thread() for r in self.queue):
+                self.condition.wait()
+                owner = self.waitDevice(address)
+            depth = owner[1] if owner is not None else 0
+            self.owners[address] = (threading.current_thread(), depth + 1)
+
+    def release(self, address):
+        with self.condition:
+            thread, depth = self.owners[address]
+            if depth > 1:
+                self.owners[address] = (thread, depth - 1)
+            else:
+                del self.owners[address]
+                self.condition.notify_all()
+
+    def submit(self, operation, addresses, *args):
+        request = Request(operation, args, addresses)
+        with self.condition:
+            # All devices at once: waiting for each in turn would miss one taken while waiting for the next
+            while self.heldElsewhere(addresses):
+                self.condition.wait()
+            self.queue.append(request)
+            while self.busy and not request.done:
+                self.condition.wait()
+            if request.done:
+                return request.get()
+            self.busy = True
+
+        try:
+            self.drain()
+        finally:
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+        return request.get()
+
+    def drain(self):
+        while True:
+            with self.condition:
+                batch = self.queue
+                self.queue = []
+            if not batch:
+                return
+
+            self.batches += 1
+            try:
+                self.run(batch)
+            finally:
+                # Even if something went wrong, no thread waits on a request that will never be run
+                with self.condition:
+                    for request in batch:
+                        request.done = True
+                    self.condition.notify_all()
+
+    def run(self, batch):
+        results = {}
+        for request in batch:
+            key = (request.operation,) + request.args
+            if request.operation not in BusArbiter.READS:
+                # A write invalidates coalesced reads from the same device
+                address = request.addresses[0]
+                results = dict((k, v) for k, v in results.items() if address not in v[2])
+            elif key in results:
+                request.result, request.error = results[key][:2]
+                self.coalesced += 1
+                continue
+
+            try:
+                if request.operation == "read_blocks":
+                    request.result = buses.readBlocks(self.bus, *request.args)
+                else:
+                    request.result = getattr(self.bus, request.operation)(*request.args)
+            except Exception as e:
+                # Raised again by get() in the thread that submitted the request
+                request.error = e
+            self.transactions += 1
+
+            if request.operation in BusArbiter.READS:
+                results[key] = (request.result, request.error, request.addresses)
+
+    def read_byte_data(self, address, register):
+        return self.submit("read_byte_data", [address], address, register)
+
+    def read_i2c_block_data(self, address, register, length):
+        return list(self.submit("read_i2c_block_data", [address], address, register, length))
+
+    def write_byte_data(self, address, register, value):
+        return self.submit("write_byte_data", [address], address, register, value)
+
+    def write_i2c_block_data(self, address, register, data):
+        return self.submit("write_i2c_block_data", [address], address, register, data)
+
+    def read_blocks(self, requests):
+        requests = tuple(tuple(request) for request in requests)
+        blocks = self.submit("read_blocks", sorted(set(r[0] for r in requests)), requests)
+        return [list(block) for block in blocks]
+
+    def close(self):
+        self.bus.close()
+
+def exclusive(bus, address):
+    # Holds one device for a sequence of transactions. Plain buses are single-threaded, so nothing to lock.
+    if isinstance(bus, BusArbiter):
+        return bus.device(address)
+    return NoLock()
@@ -0,0 +1,87 @@
+import struct
+from collections import namedtuple
+
+# BMP280 compensation, following the reference code in the Bosch datasheet (section 8.2)
+
+# Calibration registers 0x88-0x9F: dig_T1 is unsigned, dig_T2-T3 signed, dig_P1 unsigned, dig_P2-P9 signed
+TRIM = struct.Struct("<HhhHhhhhhhhh")
+
+class Trim(namedtuple("Trim", ["T1", "T2", "T3", "P1", "P2", "P3", "P4", "P5", "P6", "P7", "P8", "P9"])):
+    __slots__ = ()
+
+    @staticmethod
+    def unpack(block):
+        return Trim(*TRIM.unpack(bytearray(block[:TRIM.size])))
+
+def split(data):
+    # Returns (adc_T, adc_P) from the 6 data registers 0xF7-0xFC, 20 bits each
+    adcP = (data[0] << 12) | (data[1] << 4) | (data[2] >> 4)
+    adcT = (data[3] << 12) | (data[4] << 4) | (data[5] >> 4)
+    return adcT, adcP
+
+def divide(a, b):
+    # Integer division truncating towards zero like C, Python's // rounds down
+    q = abs(a) // abs(b)
+    return q if (a >= 0) == (b > 0) else -q
+
+def compensateTemperature(trim, adcT):
+    # Returns (t_fine, temperature in 0.01 degrees C), 32-bit integer version
+    var1 = (((adcT >> 3) - (trim.T1 << 1)) * trim.T2) >> 11
+    var2 = (((((adcT >> 4) - trim.T1) * ((adcT >> 4) - trim.T1)) >> 12) * trim.T3) >> 14
+    fine = var1 + var2
+    return fine, (fine * 5 + 128) >> 8
+
+def compensatePressure(trim, adcP, fine):
+    # Returns pressure in Pa as unsigned Q24.8 (divide by 256), 64-bit integer version
+    var1 = fine - 128000
+    var2 = var1 * var1 * trim.P6
+    var2 = var2 + ((var1 * trim.P5) << 17)
+    var2 = var2 + (trim.P4 << 35)
+    var1 = ((var1 * var1 * trim.P3) >> 8) + ((var1 * trim.P2) << 12)
+    var1 = (((1 << 47) + var1) * trim.P1) >> 33
+    if var1 == 0:
+        # Avoids a division by zero on an unprogrammed chip
+        return 0
+    p = 1048576 - adcP
+    p = divide(((p << 31) - var2) * 3125, var1)
+    var1 = (trim.P9 * (p >> 13) * (p >> 13)) >> 25
+    var2 = (trim.P8 * p) >> 19
+    return ((p + var1 + var2) >> 8) + (trim.P7 << 4)
+
+def compensate(trim, adcT, adcP):
+    # Returns (temperature in degrees C, pressure in Pa)
+    fine, temperature = compensateTemperature(trim, adcT)
+    return temperature / 100.0, compensatePressure(trim, adcP, fine) / 256.0
+
+def compensateBatch(trim, adcT, adcP):
+    # Vectorized compensate() for arrays of raw ADC values, e.g. a whole log. Same integer arithmetic,
+    # so the results match the live readings exactly. Needs NumPy.
+    import numpy as np
+
+    adcT = np.asarray(adcT, dtype=np.int64)
+    adcP = np.asarray(adcP, dtype=np.int64)
+    T1, T2, T3, P1, P2, P3, P4, P5, P6, P7, P8, P9 = [np.int64(v) for v in trim]
+
+    var1 = (((adcT >> 3) - (T1 << 1)) * T2) >> 11
+    var2 = (((((adcT >> 4) - T1) * ((adcT >> 4) - T1)) >> 12) * T3) >> 14
+    fine = var1 + var2
+    temperature = (fine * 5 + 128) >> 8
+
+    var1 = fine - 128000
+    var2 = var1 * var1 * P6
+    var2 = var2 + ((var1 * P5) << 17)
+    var2 = var2 + (P4 << 35)
+    var1 = ((var1 * var1 * P3) >> 8) + ((var1 * P2) << 12)
+    var1 = (((np.int64(1) << 47) + var1) * P1) >> 33
+    valid = var1 != 0
+    var1 = np.where(valid, var1, 1)
+    p = 1048576 - adcP
+    numerator = ((p << 31) - var2) * 3125
+    p = np.abs(numerator) // np.abs(var1)
+    p = np.where((numerator >= 0) == (var1 > 0), p, -p)
+    var1 = (P9 * (p >> 13) * (p >> 13)) >> 25
+    var2 = (P8 * p) >> 19
+    p = ((p + var1 + var2) >> 8) + (P7 << 4)
+    p = np.where(valid, p, 0)
+
+    return temperature / 100.0, p / 256.0
@@ -0,0 +1,270 @@
+import time
+import atexit
+
+clock = getattr(time, "perf_counter", time.time)
+
+class Bus():
+    # Buses implement the subset of the smbus.SMBus interface the sensors use:
+    # read_byte_data, read_i2c_block_data, write_byte_data and write_i2c_block_data,
+    # plus read_blocks, which reads several (address, register, length) blocks in one combined transaction
+
+    # Devices that only auto-increment when the register MSB is set (LSM9DS1 magnetometer, LSM9DS0 XM)
+    AUTO_INCREMENT_ADDRESSES = [0x1C, 0x1E]
+
+    # Devices that take multi-byte writes as register/value pairs (BMP280)
+    PAIR_WRITE_ADDRESSES = [0x76, 0x77]
+
+    def __init__(self, frequency=None, overhead=0):
+        self.frequency = frequency
+        self.overhead = overhead
+
+    def delay(self, size):
+        # Busy wait for the time the transaction would take on a real bus.
+        # size counts every byte on the wire, including address and register bytes.
+        duration = self.overhead
+        if self.frequency:
+            duration += size * 9.0 / self.frequency
+        if duration <= 0:
+            return
+        deadline = clock() + duration
+        while clock() < deadline:
+            pass
+
+    def close(self):
+        return
+
+class SimulatedBus(Bus):
+    # LSM9DS1 accel/gyro (0x6A), magnetometer (0x1C) and BMP280 (0x77) at rest, reading 1g on Z
+    DEFAULT_REGISTERS = {
+        0x6A: {0x0F: [0x68],
+               0x18: [0x0A, 0x00, 0xF6, 0xFF, 0x05, 0x00],
+               0x22: [0x04],
+               0x27: [0x03],
+               0x28: [0x20, 0x00, 0xC0, 0xFF, 0x01, 0x40]},
+        0x1C: {0x0F: [0x3D],
+               0x27: [0x08],
+               0x28: [0x2C, 0x01, 0x9C, 0xFF, 0x20, 0xFE]},
+        # Trim and ADC values are the worked example from the BMP280 datasheet
+        0x77: {0x88: [0x70, 0x6B, 0x43, 0x67, 0x18, 0xFC, 0x7D, 0x8E, 0x43, 0xD6, 0xD0, 0x0B,
+                      0x27, 0x0B, 0x8C, 0x00, 0xF9, 0xFF, 0x8C, 0x3C, 0xF8, 0xC6, 0x70, 0x17],
+               0xD0: [0x58],
+               0xF7: [0x65, 0x5A, 0xC0, 0x7E, 0xED, 0x00]},
+    }
+
+    def __init__(self, frequency=None, overhead=0, registers=None):
+        Bus.__init__(self, frequency, overhead)
+        self.registers = {}
+        for address, values in (registers or SimulatedBus.DEFAULT_REGISTERS).items():
+            memory = self.registers.setdefault(address, bytearray(256))
+            for register, data in values.items():
+                memory[register:register + len(data)] = bytearray(data)
+
+    def memory(self, address, register):
+        if address not in self.registers:
+            raise IOError("No device at address 0x%02X" % address)
+        if address in Bus.AUTO_INCREMENT_ADDRESSES:
+            register &= 0x7F
+        return self.registers[address], register
+
+    def read_byte_data(self, address, register):
+        memory, register = self.memory(address, register)
+        self.delay(4)
+        return memory[register]
+
+    def read_i2c_block_data(self, address, register, length):
+        memory, register = self.memory(address, register)
+        self.delay(3 + length)
+        return list(memory[register:register + length])
+
+    def write_byte_data(self, address, register, value):
+        memory, register = self.memory(address, register)
+        self.delay(3)
+        memory[register] = value & 0xFF
+
+    def write_i2c_block_data(self, address, register, data):
+        memory, register = self.memory(address, register)
+        self.delay(2 + len(data))
+        if address in Bus.PAIR_WRITE_ADDRESSES:
+            registers = [register] + list(data[1::2])
+            for register, value in zip(registers, data[0::2]):
+                memory[register] = value
+        else:
+            memory[register:register + len(data)] = bytearray(data)
+
+    def read_blocks(self, requests):
+        blocks = []
+        for address, register, length in requests:
+            memory, register = self.memory(address, register)
+            blocks.append(list(memory[register:register + length]))
+        self.delay(sum(4 + length for address, register, length in requests) - 1)
+        return blocks
+
+class RecordingBus(Bus):
+    # Passes every transaction through to a real bus and appends it to a text file, one per line:
+    # <operation> <address> <register> <data bytes...>, all in hex
+
+    def __init__(self, bus, path):
+        Bus.__init__(self)
+        self.bus = bus
+        self.file = open(path, "w")
+
+    def record(self, operation, address, register, data):
+        self.file.write("%s %02x %02x %s\n" % (operation, address, register, " ".join("%02x" % b for b in data)))
+
+    def read_byte_data(self, address, register):
+        value = self.bus.read_byte_data(address, register)
+        self.record("read", address, register, [value])
+        return value
+
+    def read_i2c_block_data(self, address, register, length):
+        data = self.bus.read_i2c_block_data(address, register, length)
+        self.record("read_block", address, register, data)
+        return data
+
+    def write_byte_data(self, address, register, value):
+        self.bus.write_byte_data(address, register, value)
+        self.record("write", address, register, [value])
+
+    def write_i2c_block_data(self, address, register, data):
+        self.bus.write_i2c_block_data(address, register, data)
+        self.record("write_block", address, register, data)
+
+    def read_blocks(self, requests):
+        blocks = readBlocks(self.bus, requests)
+        for (address, register, length), data in zip(requests, blocks):
+            self.record("read_block", address, register, data)
+        return blocks
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+class ReplayBus(Bus):
+    # Answers reads from a RecordingBus file. Each (address, register, length) read returns its recorded
+    # responses in order and starts over once they run out, so a short capture can drive a long benchmark.
+    # Writes are accepted and dropped. Reads that were never recorded fail like a missing device.
+
+    def __init__(self, path, frequency=None, overhead=0):
+        Bus.__init__(self, frequency, overhead)
+        self.responses = {}
+        self.positions = {}
+
+        with open(path) as file:
+            for line in file:
+                fields = line.split()
+                if not fields or not fields[0].startswith("read"):
+                    continue
+                address, register = int(fields[1], 16), int(fields[2], 16)
+                data = [int(b, 16) for b in fields[3:]]
+                self.responses.setdefault((address, register, len(data)), []).append(data)
+
+    def replay(self, address, register, length):
+        key = (address, register, length)
+        if key not in self.responses:
+            raise IOError("No recorded read of %d bytes from 0x%02X:0x%02X" % (length, address, register))
+        responses = self.responses[key]
+        position = self.positions.get(key, 0)
+        self.positions[key] = (position + 1) % len(responses)
+        return responses[position]
+
+    def read_byte_data(self, address, register):
+        self.delay(4)
+        return self.replay(address, register, 1)[0]
+
+    def read_i2c_block_data(self, address, register, length):
+        self.delay(3 + length)
+        return list(self.replay(address, register, length))
+
+    def write_byte_data(self, address, register, value):
+        self.delay(3)
+
+    def write_i2c_block_data(self, address, register, data):
+        self.delay(2 + len(data))
+
+    def read_blocks(self, requests):
+        self.delay(sum(4 + length for address, register, length in requests) - 1)
+        return [list(self.replay(address, register, length)) for address, register, length in requests]
+
+class CombinedBus(Bus):
+    # Hardware bus through smbus2, which can send several messages in one I2C_RDWR ioctl.
+    # read_blocks packs a register write and a read for every block into a single syscall,
+    # joined by repeated starts on the wire.
+
+    def __init__(self, number):
+        Bus.__init__(self)
+        import smbus2
+        self.messages = smbus2.i2c_msg
+        self.bus = smbus2.SMBus(number)
+
+    def read_byte_data(self, address, register):
+        return self.bus.read_byte_data(address, register)
+
+    def read_i2c_block_data(self, address, register, length):
+        return self.bus.read_i2c_block_data(address, register, length)
+
+    def write_byte_data(self, address, register, value):
+        self.bus.write_byte_data(address, register, value)
+
+    def write_i2c_block_data(self, address, register, data):
+        self.bus.write_i2c_block_data(address, register, data)
+
+    def read_blocks(self, requests):
+        messages = []
+        for address, register, length in requests:
+            messages.append(self.messages.write(address, [register]))
+            messages.append(self.messages.read(address, length))
+        self.bus.i2c_rdwr(*messages)
+        return [list(messages[i + 1]) for i in range(0, len(messages), 2)]
+
+    def close(self):
+        self.bus.close()
+
+def readBlocks(bus, requests):
+    # Reads (address, register, length) blocks, combined into one transaction when the bus supports it
+    if hasattr(bus, "read_blocks"):
+        return bus.read_blocks(requests)
+    return [bus.read_i2c_block_data(address, register, length) for address, register, length in requests]
+
+def name(spec):
+    # Names the physical bus a spec reaches, the same for every driver on it: i2c-<number> for the hardware
+    # bus, whether through smbus, smbus2 or a recording, otherwise the kind of bus, e.g. sim
+    fields = spec.split(":")
+    kind = fields[0]
+    if kind in ["smbus", "smbus2"]:
+        return "i2c-%d" % (int(fields[1]) if len(fields) > 1 else 1)
+    if kind == "record":
+        return "i2c-%d" % int(fields[1])
+    return kind
+
+def connect(spec):
+    # Connects to a bus described by a spec string:
+    #   smbus:<number>                 the hardware bus, /dev/i2c-<number>
+    #   smbus2:<number>                the hardware bus through smbus2, with combined block reads
+    #   record:<number>:<path>         the hardware bus, recording all traffic to <path>
+    #   replay:<path>[:<hz>[:<s>]]     recorded traffic replayed at an optional bus frequency and per-transaction overhead
+    #   sim[:<hz>[:<s>]]               a simulated LSM9DS1 and BMP280
+    fields = spec.split(":")
+    kind = fields[0]
+
+    if kind == "smbus":
+        import smbus
+        return smbus.SMBus(int(fields[1]) if len(fields) > 1 else 1)
+
+    if kind == "smbus2":
+        return CombinedBus(int(fields[1]) if len(fields) > 1 else 1)
+
+    if kind == "record":
+        import smbus
+        bus = RecordingBus(smbus.SMBus(int(fields[1])), fields[2])
+        atexit.register(bus.close)
+        return bus
+
+    if kind == "replay":
+        timing = [float(f) for f in fields[2:]]
+        return ReplayBus(fields[1], *timing)
+
+    if kind == "sim":
+        timing = [float(f) for f in fields[1:]]
+        return SimulatedBus(*timing)
+
+    raise ValueError("Unknown bus %s" % spec)
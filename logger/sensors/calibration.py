@@ -0,0 +1,204 @@
+import os
+import json
+import time
+from array import array
+
+from sensors import bus as buses
+
+# NumPy is only needed to fit soft-iron calibration, without it profiles fall back to min/max offsets
+try:
+    from sensors import ellipsoid
+except ImportError:
+    ellipsoid = None
+
+# Bumped whenever the profile layout changes, profiles written by other versions are ignored
+VERSION = 2
+
+# Profiles older than this still load, but get refreshed in the background
+MAX_AGE = 30 * 24 * 60 * 60
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".berryimu", "calibration.json")
+
+# Largest spread of corrected field magnitudes an ellipsoid fit may leave, as a fraction of the mean.
+# Partial rotations give fits that miss this, and fall back to min/max offsets.
+MAX_RESIDUAL = 0.05
+
+IDENTITY = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0], [0.0, 0.0, 1.0]]
+
+class Profile():
+    # Magnetometer calibration: corrected = matrix . (raw - offset). The offset removes hard-iron error and
+    # the matrix soft-iron scaling and skew. The per-axis extremes seen while the device was rotated are kept
+    # to judge later calibrations, and give the offset when no ellipsoid was fitted.
+
+    def __init__(self, minimum, maximum, offset=None, matrix=None, created=None):
+        self.minimum = list(minimum)
+        self.maximum = list(maximum)
+        if offset is None:
+            offset = [(low + high) / 2.0 for low, high in zip(self.minimum, self.maximum)]
+        self.offset = [float(v) for v in offset]
+        self.matrix = [[float(v) for v in row] for row in (IDENTITY if matrix is None else matrix)]
+        self.created = time.time() if created is None else created
+
+    def correct(self, xyz):
+        x = xyz[0] - self.offset[0]
+        y = xyz[1] - self.offset[1]
+        z = xyz[2] - self.offset[2]
+        return [row[0] * x + row[1] * y + row[2] * z for row in self.matrix]
+
+    def correctBatch(self, samples):
+        # Corrects an n x 3 array of raw samples, needs NumPy
+        return ellipsoid.apply(samples, self.offset, self.matrix)
+
+    def span(self):
+        return [high - low for low, high in zip(self.minimum, self.maximum)]
+
+    def age(self):
+        return time.time() - self.created
+
+    def stale(self):
+        return self.age() > MAX_AGE
+
+    def covers(self, other, fraction=0.5):
+        # True if this profile saw at least fraction of the other's range on every axis,
+        # i.e. the device was actually rotated while it was collected
+        return all(mine >= fraction * theirs for mine, theirs in zip(self.span(), other.span()))
+
+    def toDict(self):
+        return {"minimum": self.minimum, "maximum": self.maximum, "offset": self.offset, "matrix": self.matrix,
+                "created": self.created}
+
+    @staticmethod
+    def fromDict(values):
+        return Profile(values["minimum"], values["maximum"], values["offset"], values["matrix"], values["created"])
+
+    def __str__(self):
+        return "Offset X: %.2f\t Y: %.2f\t Z: %.2f\t Matrix: %s" % (
+            tuple(self.offset) + (" ".join("%.3f" % v for row in self.matrix for v in row),))
+
+def fit(samples):
+    # Builds a profile from raw samples (x, y, z) collected while the device was rotated. Fits an ellipsoid
+    # when NumPy is available and the fit is good, otherwise uses min/max offsets.
+    minimum = [min(axis) for axis in zip(*samples)]
+    maximum = [max(axis) for axis in zip(*samples)]
+    if ellipsoid is not None:
+        try:
+            offset, matrix = ellipsoid.fit(samples)
+        except ValueError:
+            pass
+        else:
+            if ellipsoid.residual(samples, offset, matrix) <= MAX_RESIDUAL:
+                return Profile(minimum, maximum, offset.tolist(), matrix.tolist())
+    return Profile(minimum, maximum)
+
+# Directions from the centre of the field sphere the device has to be turned through: the 6 faces,
+# 12 edges and 8 corners of a cube around it
+DIRECTIONS = [(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1) if (x, y, z) != (0, 0, 0)]
+
+# A direction component counts when it is at least tan(22.5 deg) of the largest one
+DIRECTION_THRESHOLD = 0.414
+
+class Collector():
+    # Gathers raw samples into a preallocated array while the device is rotated, and decides when there are
+    # enough: the samples must point in most DIRECTIONS from the current centre estimate, and the min/max
+    # estimate must have stopped moving for a few checks in a row.
+
+    def __init__(self, capacity=6000, coverage=0.9, tolerance=0.01, checks=4, interval=40):
+        self.capacity = capacity
+        self.samples = array("h", [0]) * (capacity * 3)
+        self.count = 0
+        self.minimum = [32767] * 3
+        self.maximum = [-32768] * 3
+        self.coverageThreshold = coverage
+        self.tolerance = tolerance
+        self.checks = checks
+        self.interval = interval
+        self.covered = 0.0
+        self.stable = 0
+        self.previous = None
+
+    def add(self, xyz):
+        if self.full():
+            return
+        start = self.count * 3
+        self.samples[start:start + 3] = array("h", xyz)
+        self.count += 1
+        self.minimum = [min(a, b) for a, b in zip(self.minimum, xyz)]
+        self.maximum = [max(a, b) for a, b in zip(self.maximum, xyz)]
+        if self.count % self.interval == 0:
+            self.check()
+
+    def check(self):
+        centre = [(low + high) / 2.0 for low, high in zip(self.minimum, self.maximum)]
+        radius = [max(high - low, 1) / 2.0 for low, high in zip(self.minimum, self.maximum)]
+
+        seen = set()
+        samples = self.samples
+        for start in range(0, self.count * 3, 3):
+            u = [(samples[start + i] - centre[i]) / radius[i] for i in range(3)]
+            largest = max(abs(v) for v in u)
+            if largest > 0:
+                seen.add(tuple(0 if abs(v) < DIRECTION_THRESHOLD * largest else (1 if v > 0 else -1) for v in u))
+        self.covered = len(seen) / float(len(DIRECTIONS))
+
+        # Converged once neither the centre nor the radius moved by more than tolerance of the radius
+        estimate = centre + radius
+        limit = self.tolerance * sum(radius) / 3
+        if self.previous is not None and all(abs(a - b) <= limit for a, b in zip(estimate, self.previous)):
+            self.stable += 1
+        else:
+            self.stable = 0
+        self.previous = estimate
+
+    def coverage(self):
+        return self.covered
+
+    def converged(self):
+        return self.stable >= self.checks
+
+    def full(self):
+        return self.count >= self.capacity
+
+    def complete(self):
+        return self.covered >= self.coverageThreshold and self.converged()
+
+    def profile(self):
+        samples = self.samples
+        return fit([samples[i:i + 3].tolist() for i in range(0, self.count * 3, 3)])
+
+def key(spec, address):
+    # Calibration belongs to the board, so a profile is found again whichever driver reaches its bus
+    return "%s/0x%02X" % (buses.name(spec), address)
+
+class Store():
+    # Calibration profiles in one JSON file, keyed by device (bus and address)
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+
+    def read(self):
+        try:
+            with open(self.path) as file:
+                contents = json.load(file)
+        except (IOError, OSError, ValueError):
+            return {}
+        if contents.get("version") != VERSION:
+            return {}
+        return contents.get("devices", {})
+
+    def load(self, key):
+        values = self.read().get(key)
+        return Profile.fromDict(values) if values is not None else None
+
+    def save(self, key, profile):
+        devices = self.read()
+        devices[key] = profile.toDict()
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Write a new file and rename it over the old one, so a crash never leaves a truncated profile
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump({"version": VERSION, "devices": devices}, file, indent=2, sort_keys=True)
+        os.rename(temporary, self.path)
@@ -0,0 +1,44 @@
+import time
+
+# Monotonic timestamps in integer nanoseconds, unaffected by wall clock changes. Python 3.7 has
+# time.monotonic_ns, Python 2 (the output scripts) reads CLOCK_MONOTONIC through ctypes.
+
+NANOSECONDS = 1000000000
+
+if hasattr(time, "monotonic_ns"):
+    monotonic_ns = time.monotonic_ns
+
+elif hasattr(time, "monotonic"):
+    def monotonic_ns():
+        return int(time.monotonic() * NANOSECONDS)
+
+else:
+    import ctypes
+    import ctypes.util
+
+    class Timespec(ctypes.Structure):
+        _fields_ = [("seconds", ctypes.c_long), ("nanoseconds", ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 1
+
+    try:
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c")).clock_gettime
+    except (OSError, AttributeError, TypeError):
+        # No librt, e.g. not on Linux: the wall clock is the best there is
+        def monotonic_ns():
+            return int(time.time() * NANOSECONDS)
+    else:
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(Timespec)]
+
+        def monotonic_ns():
+            now = Timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(now)) != 0:
+                raise OSError(ctypes.get_errno(), "clock_gettime failed")
+            return now.seconds * NANOSECONDS + now.nanoseconds
+
+def monotonic():
+    # Seconds, as a float
+    return monotonic_ns() / float(NANOSECONDS)
+
+def seconds(nanoseconds):
+    return nanoseconds / float(NANOSECONDS)
@@ -0,0 +1,50 @@
+import numpy as np
+
+# Quadric coefficients to solve for, so small samples are rejected before the fit
+MIN_SAMPLES = 9
+
+def fit(samples):
+    # Fits an ellipsoid to raw magnetometer samples (n x 3) by linear least squares on the general quadric
+    #   a x^2 + b y^2 + c z^2 + 2d xy + 2e xz + 2f yz + 2g x + 2h y + 2i z = 1
+    # and returns (offset, matrix) such that matrix . (raw - offset) lies on a sphere. The offset is the
+    # hard-iron error, the matrix undoes soft-iron scaling and skew. The sphere radius is the geometric mean
+    # of the ellipsoid's semi-axes, so corrected values stay in raw sensor units.
+    samples = np.asarray(samples, dtype=np.float64)
+    if samples.ndim != 2 or samples.shape[1] != 3 or len(samples) < MIN_SAMPLES:
+        raise ValueError("Need at least %d samples of x, y and z" % MIN_SAMPLES)
+
+    # Centre and scale first, raw counts squared would make the system badly conditioned
+    mean = samples.mean(axis=0)
+    scale = np.abs(samples - mean).max()
+    if scale == 0:
+        raise ValueError("Samples do not span any volume")
+    x, y, z = ((samples - mean) / scale).T
+
+    design = np.column_stack([x * x, y * y, z * z, 2 * x * y, 2 * x * z, 2 * y * z, 2 * x, 2 * y, 2 * z])
+    a, b, c, d, e, f, g, h, i = np.linalg.lstsq(design, np.ones(len(samples)), rcond=None)[0]
+
+    quadratic = np.array([[a, d, e], [d, b, f], [e, f, c]])
+    linear = np.array([g, h, i])
+    centre = -np.linalg.solve(quadratic, linear)
+
+    # Moved to the centre the ellipsoid is (p - centre)' shape (p - centre) = 1
+    shape = quadratic / (1 + centre.dot(quadratic).dot(centre))
+    values, vectors = np.linalg.eigh(shape)
+    if np.any(values <= 0):
+        raise ValueError("Samples do not fit an ellipsoid")
+
+    radius = np.prod(1 / np.sqrt(values)) ** (1.0 / 3)
+    matrix = vectors.dot(np.diag(np.sqrt(values) * radius)).dot(vectors.T)
+
+    # Undo the normalisation: the matrix is scale invariant, the offset is not
+    return mean + centre * scale, matrix
+
+def apply(samples, offset, matrix):
+    # Corrects a batch of raw samples (n x 3) in one go
+    samples = np.asarray(samples, dtype=np.float64)
+    return (samples - np.asarray(offset)).dot(np.asarray(matrix).T)
+
+def residual(samples, offset, matrix):
+    # Spread of corrected sample magnitudes relative to their mean, 0 for a perfect sphere
+    lengths = np.linalg.norm(apply(samples, offset, matrix), axis=1)
+    return lengths.std() / lengths.mean()
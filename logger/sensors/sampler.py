@@ -0,0 +1,277 @@
+import threading
+from array import array
+
+from sensors import scheduler
+from storage import binlog
+
+class RingBuffer():
+    # Fixed-size, preallocated store of timestamped raw samples for one writer and any number of readers.
+    # The writer never blocks and readers never take a lock: each slot carries the sequence number of the
+    # sample in it, cleared while the slot is being rewritten, and a reader retries if that number changed
+    # while it was copying the slot.
+
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.width = width
+        self.timestamps = array("q", [0] * capacity)
+        self.values = array("h", [0] * (capacity * width))
+        self.sequences = array("q", [-1] * capacity)
+        self.count = 0
+
+    def append(self, timestamp, values):
+        sequence = self.count
+        slot = sequence % self.capacity
+        start = slot * self.width
+
+        self.sequences[slot] = -1
+        self.timestamps[slot] = timestamp
+        self.values[start:start + self.width] = array("h", values)
+        self.sequences[slot] = sequence
+        self.count = sequence + 1
+
+    def get(self, sequence):
+        # Returns (timestamp, values) for a sample, or None once it has been overwritten
+        slot = sequence % self.capacity
+        start = slot * self.width
+        while True:
+            if self.sequences[slot] != sequence:
+                return None
+            timestamp = self.timestamps[slot]
+            values = self.values[start:start + self.width].tolist()
+            if self.sequences[slot] == sequence:
+                return timestamp, values
+
+    def latest(self):
+        while True:
+            count = self.count
+            if count == 0:
+                return None
+            sample = self.get(count - 1)
+            if sample is not None:
+                return sample
+
+    def window(self, size):
+        # Returns up to size of the newest samples, oldest first
+        count = self.count
+        samples = []
+        for sequence in range(max(0, count - min(size, self.capacity)), count):
+            sample = self.get(sequence)
+            if sample is not None:
+                samples.append(sample)
+        return samples
+
+class Sampler(threading.Thread):
+    # Owns the bus for the IMU: reads each sensor on its own period, matched to the output data rate it is
+    # configured for, so slow sensors aren't polled for data they don't have yet. Every accel/gyro read, the
+    # fastest stream, is stored together with the latest magnetometer values in a RingBuffer, tagged with
+    # the clock.monotonic_ns() of the read. The latest raw pressure reading is kept alongside.
+    # Consumers read the latest sample or a window from memory, and every sample can also go to a log.
+    #
+    # The mode decides how the accel/gyro stream is read:
+    #   ODR     read the output registers on a timer at the output data rate
+    #   FIFO    let the hardware FIFO collect the samples and drain it every FIFO_BURST of them, so none are
+    #           missed or read twice and the thread wakes up far less often. Always at the output data rate.
+    #   STATUS  poll STATUS_REG and STATUS_REG_M STATUS_POLLS times per output data period and read a sensor
+    #           only when it flags new data, skipping duplicates and counting magnetometer overruns
+    WIDTH = 9
+
+    ODR = "odr"
+    FIFO = "fifo"
+    STATUS = "status"
+    MODES = [ODR, FIFO, STATUS]
+
+    # Half the FIFO, leaving room for a late drain
+    FIFO_BURST = 16
+
+    STATUS_POLLS = 2
+
+    def __init__(self, imu, rate=None, capacity=1024, pressure=None, log=None, mode=ODR):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.imu = imu
+        self.mode = mode
+        self.pressure = pressure
+        self.log = log
+        self.loggedMagTime = None
+        self.loggedPressureTime = None
+        self.buffer = RingBuffer(capacity, Sampler.WIDTH)
+        self.running = False
+        self.errors = 0
+        self.samples = 0
+        # Polls that found no new data, and magnetometer samples overwritten before they were read
+        self.skipped = 0
+        self.overruns = 0
+        self.mag = [0, 0, 0]
+        self.magTime = None
+        # (timestamp, adc_T, adc_P) of the latest pressure reading
+        self.pressureReading = None
+
+        # An explicit rate overrides the ODR, and no sensor is read faster than it
+        inertialRate = rate if rate and mode != Sampler.FIFO else imu.gyr.odr()
+        magRate = min(imu.mag.odr(), inertialRate)
+
+        # A late read is simply the newest sample, so missed ticks are skipped rather than made up. Every read
+        # carries its own timestamp, so the thread sleeps right up to each deadline instead of spinning.
+        self.scheduler = scheduler.MultiRateScheduler(spin=0)
+        if mode == Sampler.FIFO:
+            self.scheduler.add("FIFO", float(Sampler.FIFO_BURST) / inertialRate, self.drainFIFO)
+        elif mode == Sampler.STATUS:
+            polls = Sampler.STATUS_POLLS
+            self.scheduler.add("Accel/Gyro", 1.0 / (inertialRate * polls), self.pollInertial)
+            self.scheduler.add("Magnetometer", 1.0 / (magRate * polls), self.pollMagnetometer)
+        else:
+            self.scheduler.add("Accel/Gyro", 1.0 / inertialRate, self.readInertial)
+        if mode != Sampler.STATUS:
+            self.scheduler.add("Magnetometer", 1.0 / magRate, self.readMagnetometer)
+        # A forced conversion takes up to 43 ms, so one task starts it and another reads the result
+        # measurementTime() later. No task ever waits on the bus.
+        self.converting = False
+        if pressure is not None and pressure.forced:
+            self.scheduler.add("Pressure", pressure.period(), self.startPressure)
+            self.scheduler.add("Pressure read", pressure.period(), self.readPressure,
+                               offset=pressure.measurementTime())
+        elif pressure is not None:
+            self.scheduler.add("Pressure", pressure.period(), self.readPressure)
+
+    def start(self):
+        # Read everything once, so the first fused samples don't carry placeholder values
+        self.readMagnetometer()
+        if self.pressure is not None:
+            if self.pressure.forced:
+                try:
+                    self.pressure.measure()
+                    self.converting = True
+                except IOError:
+                    self.errors += 1
+            self.readPressure()
+            # Reads of the pressure sensor are served from what the sampler reads from now on
+            self.pressure.sampler = self
+        if self.mode == Sampler.FIFO:
+            self.imu.enableFIFO()
+        self.running = True
+        threading.Thread.start(self)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        if self.pressure is not None:
+            self.pressure.sampler = None
+        if self.mode == Sampler.FIFO:
+            try:
+                self.imu.disableFIFO()
+            except IOError:
+                self.errors += 1
+        if self.log is not None:
+            self.log.close()
+
+    def run(self):
+        while self.running:
+            self.scheduler.runOnce()
+
+    def readInertial(self):
+        try:
+            acc, gyr = self.imu.readInertial()
+        except IOError:
+            self.errors += 1
+        else:
+            self.store(self.imu.timestamp, acc + gyr + self.mag)
+
+    def pollInertial(self):
+        try:
+            ready = self.imu.inertialReady()
+        except IOError:
+            self.errors += 1
+        else:
+            if ready:
+                self.readInertial()
+            else:
+                self.skipped += 1
+
+    def drainFIFO(self):
+        try:
+            samples = self.imu.drainFIFO()
+        except IOError:
+            self.errors += 1
+        else:
+            for timestamp, acc, gyr in samples:
+                self.store(timestamp, acc + gyr + self.mag)
+
+    def store(self, timestamp, values):
+        self.samples += 1
+        self.buffer.append(timestamp, values)
+        if self.log is not None:
+            self.record(timestamp, values)
+
+    def record(self, timestamp, values):
+        # Flags which of the slower readings are new in this record
+        flags = 0
+        if self.magTime != self.loggedMagTime:
+            self.loggedMagTime = self.magTime
+            flags |= binlog.FLAG_MAG
+        adcT, adcP = 0, 0
+        if self.pressureReading is not None:
+            pressureTime, adcT, adcP = self.pressureReading
+            if pressureTime != self.loggedPressureTime:
+                self.loggedPressureTime = pressureTime
+                flags |= binlog.FLAG_PRESSURE
+        self.log.append(timestamp, values, adcT, adcP, flags)
+
+    def readMagnetometer(self):
+        try:
+            self.mag = self.imu.mag.readRawXYZ()
+        except IOError:
+            self.errors += 1
+        else:
+            self.magTime = self.imu.mag.timestamp
+
+    def pollMagnetometer(self):
+        try:
+            ready, overrun = self.imu.mag.readStatus()
+        except IOError:
+            self.errors += 1
+        else:
+            if overrun:
+                self.overruns += 1
+            if ready:
+                self.readMagnetometer()
+            else:
+                self.skipped += 1
+
+    def startPressure(self):
+        try:
+            self.pressure.startMeasurement()
+        except IOError:
+            self.errors += 1
+        else:
+            self.converting = True
+
+    def readPressure(self):
+        # In forced mode only once a conversion was started, a skipped start leaves nothing new to read
+        if self.pressure.forced and not self.converting:
+            return
+        self.converting = False
+        try:
+            adcT, adcP = self.pressure.readMeasurement()
+        except IOError:
+            self.errors += 1
+        else:
+            self.pressureReading = (self.pressure.timestamp, adcT, adcP)
+            self.pressure.compensate(adcT, adcP)
+
+    def latest(self):
+        sample = self.buffer.latest()
+        if sample is None:
+            return None
+        return self.imu.build(sample[1], sample[0])
+
+    def window(self, size):
+        return [self.imu.build(values, timestamp) for timestamp, values in self.buffer.window(size)]
+
+    def __str__(self):
+        text = str(self.scheduler)
+        text += "Sampling: %s\t Samples: %d\t Errors: %d" % (self.mode, self.samples, self.errors)
+        if self.mode == Sampler.FIFO:
+            text += "\t FIFO overruns: %d" % self.imu.fifoOverruns
+        if self.mode == Sampler.STATUS:
+            text += "\t Skipped: %d\t Overruns: %d" % (self.skipped, self.overruns)
+        return text + "\n"
@@ -0,0 +1,118 @@
+import time
+
+from sensors import clock
+
+class Scheduler():
+    # Runs a loop at a fixed rate by sleeping until absolute deadlines, start + n * period, instead of for
+    # a fixed time after the work. The period doesn't drift with processing time, and a late tick doesn't
+    # delay the ones after it.
+    #
+    # When a tick is missed entirely (an overrun), the policy decides what happens to it:
+    #   SKIP      drop the missed ticks and run once right away, staying in phase with the original schedule
+    #   CATCH_UP  run the missed ticks back to back until the loop is on schedule again, at most
+    #             maxCatchUp of them, so every tick happens even if some are late
+    SKIP = "skip"
+    CATCH_UP = "catch-up"
+
+    # Sleep until this close to the deadline, then spin, since sleep() tends to oversleep. Spinning costs CPU
+    # and holds the GIL, so loops that timestamp their own work pass spin=0.
+    SPIN = 200000
+
+    def __init__(self, period, policy=SKIP, maxCatchUp=10, offset=0, spin=SPIN):
+        # offset delays the whole schedule, in seconds, e.g. to run one period task a fixed time after another
+        self.period = int(period * clock.NANOSECONDS)
+        self.spin = spin
+        self.policy = policy
+        self.maxCatchUp = maxCatchUp
+        self.start = clock.monotonic_ns() + int(offset * clock.NANOSECONDS)
+        self.tick = 0
+        self.last = self.start
+
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.lateness = 0
+        self.maxLateness = 0
+        self.squaredLateness = 0
+
+    def deadline(self):
+        return self.start + self.tick * self.period
+
+    def wait(self):
+        # Blocks until the next tick and returns the time since the previous one in seconds, the dt for
+        # integrating over this loop iteration. The schedule starts when the scheduler is created.
+        sleepUntil(self.next(), self.spin)
+        return self.done()
+
+    def next(self):
+        # Moves on to the next tick, applying the overrun policy, and returns its deadline
+        now = clock.monotonic_ns()
+        self.tick += 1
+        behind = (now - self.deadline()) // self.period
+        if behind >= 1:
+            self.overruns += 1
+            if self.policy == Scheduler.SKIP or behind > self.maxCatchUp:
+                self.skipped += behind
+                self.tick += behind
+        return self.deadline()
+
+    def done(self):
+        # Called when the tick starts running, returns the dt since the previous one
+        now = clock.monotonic_ns()
+        self.record(now - self.deadline())
+        dt = clock.seconds(now - self.last)
+        self.last = now
+        return dt
+
+    def record(self, lateness):
+        self.ticks += 1
+        self.lateness += lateness
+        self.squaredLateness += lateness * lateness
+        self.maxLateness = max(self.maxLateness, lateness)
+
+    def jitter(self):
+        # (mean, standard deviation, maximum) of how late ticks ran, in seconds
+        if self.ticks == 0:
+            return 0.0, 0.0, 0.0
+        mean = self.lateness / float(self.ticks)
+        variance = max(self.squaredLateness / float(self.ticks) - mean * mean, 0)
+        return clock.seconds(mean), clock.seconds(variance ** 0.5), clock.seconds(self.maxLateness)
+
+    def __str__(self):
+        mean, deviation, maximum = self.jitter()
+        return "Ticks: %d\t Overruns: %d\t Skipped: %d\t Jitter: mean %.1f us, sd %.1f us, max %.1f us\n" % (
+            self.ticks, self.overruns, self.skipped, mean * 1000000, deviation * 1000000, maximum * 1000000)
+
+class MultiRateScheduler():
+    # Runs several tasks from one thread, each on its own period with its own Scheduler for deadlines,
+    # overrun policy and statistics. The thread sleeps until the earliest deadline, and tasks due at the
+    # same time run fastest first.
+
+    def __init__(self, spin=Scheduler.SPIN):
+        self.spin = spin
+        self.tasks = []
+
+    def add(self, name, period, function, policy=Scheduler.SKIP, offset=0):
+        scheduler = Scheduler(period, policy, offset=offset, spin=self.spin)
+        self.tasks.append([scheduler.next(), period, name, scheduler, function])
+        self.tasks.sort(key=lambda task: task[1])
+        return scheduler
+
+    def runOnce(self):
+        task = min(self.tasks, key=lambda task: task[0])
+        deadline, period, name, scheduler, function = task
+        sleepUntil(deadline, scheduler.spin)
+        scheduler.done()
+        function()
+        task[0] = scheduler.next()
+
+    def __str__(self):
+        return "".join("%s\t%s" % (name, scheduler) for deadline, period, name, scheduler, function in self.tasks)
+
+def sleepUntil(deadline, spin=Scheduler.SPIN):
+    # Sleeps until a clock.monotonic_ns() deadline, spinning for the last spin nanoseconds
+    remaining = deadline - clock.monotonic_ns()
+    if remaining > spin:
+        time.sleep((remaining - spin) / float(clock.NANOSECONDS))
+    while clock.monotonic_ns() < deadline:
+        pass
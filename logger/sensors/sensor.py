@@ -1,18 +1,69 @@
-from time import time, sleep
+from time import sleep
 import math
-import datetime
+import struct
+import threading
+from collections import namedtuple
+
+from sensors import stats
+from sensors import bus as buses
+from sensors import arbiter
+from sensors import sampler
+from sensors import calibration
+from sensors import bmp280
+from sensors import altitude
+from sensors import clock
+
+XYZ = struct.Struct("<hhh")
 
 def convert(bits, isUnsigned):
     combined = bits[0] | bits[1] << 8
     return combined if isUnsigned else (combined ^ 0x8000) - 0x8000
 
+def convertXYZ(bits):
+    return list(XYZ.unpack(bytearray(bits)))
+
+def readBlocks(bus, reads):
+    # Reads several (sensor, register, size) blocks in one combined transaction where the bus supports it
+    requests = [(sensor.address, register, size) for sensor, register, size in reads]
+    if not stats.enabled:
+        blocks = buses.readBlocks(bus, requests)
+    else:
+        blocks = stats.measureCombined([(address, size) for address, register, size in requests],
+                                       buses.readBlocks, bus, requests)
+    timestamp = clock.monotonic_ns()
+    for sensor, register, size in reads:
+        sensor.timestamp = timestamp
+    return blocks
+
+def runs(registers):
+    # Splits sorted register addresses into runs of consecutive addresses
+    groups = []
+    for register in registers:
+        if groups and groups[-1][-1] + 1 == register:
+            groups[-1].append(register)
+        else:
+            groups.append([register])
+    return groups
+
 class Sensor():
+    # Register address flag for multi-byte transfers, for devices that don't auto-increment by default
+    AUTO_INCREMENT = 0x00
+
+    # (first register, length) of each run of control registers, read in one block each the first time one
+    # of its registers is needed. Only registers that are safe to read: no outputs, nothing cleared on read.
+    CONTROL_BLOCKS = []
+
+    # Shadow copies of device registers keyed by (bus, address), shared by sensors on the same device
+    shadows = {}
+
     def __init__(self, bus, address, id, name):
         self.idRegister = 0x0F
         self.bus = bus
         self.address = address
         self.id = id
         self.name = name
+        # clock.monotonic_ns() when the last read from the device completed
+        self.timestamp = None
 
     def detect(self):
         try:
@@ -30,35 +81,140 @@ class Sensor():
         print("Initialized %s" % (self.name))
         return
 
+    def exclusive(self):
+        return arbiter.exclusive(self.bus, self.address)
+
     def read(self, register):
-        return self.bus.read_byte_data(self.address, register)
+        deviceStats = stats.get(self.address)
+        if deviceStats is None:
+            value = self.bus.read_byte_data(self.address, register)
+        else:
+            value = deviceStats.measure(1, self.bus.read_byte_data, self.address, register)
+        self.timestamp = clock.monotonic_ns()
+        return value
 
     def readBlock(self, register, size):
-        return self.bus.read_i2c_block_data(self.address, register, size)
+        deviceStats = stats.get(self.address)
+        if deviceStats is None:
+            block = self.bus.read_i2c_block_data(self.address, register, size)
+        else:
+            block = deviceStats.measure(size, self.bus.read_i2c_block_data, self.address, register, size)
+        self.timestamp = clock.monotonic_ns()
+        return block
 
     def write(self, register, value):
-        self.bus.write_byte_data(self.address, register, value)
+        deviceStats = stats.get(self.address)
+        if deviceStats is None:
+            self.bus.write_byte_data(self.address, register, value)
+        else:
+            deviceStats.measure(1, self.bus.write_byte_data, self.address, register, value)
+
+        shadow = self.shadow()
+        if register in shadow:
+            shadow[register] = value
         return -1
 
-class Accelerometer(Sensor):
+    def writeBlock(self, register, values):
+        deviceStats = stats.get(self.address)
+        if deviceStats is None:
+            self.bus.write_i2c_block_data(self.address, register | self.AUTO_INCREMENT, values)
+        else:
+            deviceStats.measure(len(values), self.bus.write_i2c_block_data, self.address, register | self.AUTO_INCREMENT, values)
+
+    def shadow(self):
+        return Sensor.shadows.setdefault((id(self.bus), self.address), {})
+
+    def readRegisters(self, registers):
+        # Fills the shadow with the given registers, reading the control block in one go the first time
+        shadow = self.shadow()
+        missing = sorted(set(r for r in registers if r not in shadow))
+        for start, length in self.CONTROL_BLOCKS:
+            if any(start <= r < start + length for r in missing):
+                shadow.update(zip(range(start, start + length), self.readBlock(start | self.AUTO_INCREMENT, length)))
+                missing = [r for r in missing if r not in shadow]
+        for register in missing:
+            shadow[register] = self.read(register)
+        return shadow
+
+    def register(self, register):
+        return self.readRegisters([register])[register]
+
+    def configure(self, registers):
+        # Writes only the registers whose shadowed value differs, one block write per run of consecutive registers
+        shadow = self.readRegisters(registers)
+        changed = sorted(r for r, value in registers.items() if shadow[r] != value)
+        for run in runs(changed):
+            if len(run) == 1:
+                self.write(run[0], registers[run[0]])
+            else:
+                self.writeBlock(run[0], [registers[r] for r in run])
+            for r in run:
+                shadow[r] = registers[r]
+
+class InertialSensor(Sensor):
+    # Accelerometer and gyroscope share one FIFO on the LSM9DS1
+    FIFO_ENABLE_REGISTER = 0x23
+    STATUS_REGISTER = 0x27
+    FIFO_CONTROL_REGISTER = 0x2E
+    FIFO_STATUS_REGISTER = 0x2F
+
+    # CTRL_REG1_G through ORIENT_CFG_G, and CTRL_REG4 through CTRL_REG10. Not INT_GEN_SRC_G (0x14), which is
+    # cleared on read, nor STATUS_REG and the gyro outputs (0x17-0x1D), which pop a FIFO slot.
+    CONTROL_BLOCKS = [(0x10, 0x04), (0x1E, 0x07)]
+
+    FIFO_ENABLE = 0b00000010
+    FIFO_BYPASS = 0b00000000
+    FIFO_CONTINUOUS = 0b11000000
+    FIFO_DEPTH = 32
+
+    def enableFIFO(self):
+        self.configure({
+            # FIFO enable register
+            # SLEEP_G(6) FIFO_TEMP_EN(4) DRDY_MASK(3) I2C_DISABLE(2) FIFO_EN(1) STOP_ON_FTH(0)
+            InertialSensor.FIFO_ENABLE_REGISTER: self.register(InertialSensor.FIFO_ENABLE_REGISTER) | InertialSensor.FIFO_ENABLE,
+
+            # FIFO control register
+            # FMODE(7-5) FTH(4-0)
+            InertialSensor.FIFO_CONTROL_REGISTER: InertialSensor.FIFO_CONTINUOUS,
+        })
+
+    def disableFIFO(self):
+        self.configure({
+            InertialSensor.FIFO_CONTROL_REGISTER: InertialSensor.FIFO_BYPASS,
+            InertialSensor.FIFO_ENABLE_REGISTER: self.register(InertialSensor.FIFO_ENABLE_REGISTER) & ~InertialSensor.FIFO_ENABLE,
+        })
+
+    def readFIFOStatus(self):
+        # Read FIFO status register
+        # FTH(7) OVRN(6) FSS(5-0)
+        status = self.read(InertialSensor.FIFO_STATUS_REGISTER)
+        return [status & 0x3F, bool(status & 0x40)]
+
+class Accelerometer(InertialSensor):
     AXIS_ENABLE_REGISTER = 0x1F
     OUTPUT_CONFIG_REGISTER = 0x20
 
+    DATA_READY = 0b00000001
+
     X_REGISTER = 0x28
     Y_REGISTER = 0x2A
     Z_REGISTER = 0x2C
 
+    SETTINGS = {
+        # Axis enablement register
+        # DEC(7-6) Z(5) Y(4) X(3) NON(2-0)
+        AXIS_ENABLE_REGISTER: 0b00111000,
+
+        # Output config register
+        # ODR(7-5) FULLSCALE(4-3) BWTOGGLE(2) BWVAL(1-0)
+        OUTPUT_CONFIG_REGISTER: 0b00100000,
+    }
+
     def __init__(self, bus):
         Sensor.__init__(self, bus, 0x6A, 0x68, "Accelerometer")
 
     def initialize(self):
-        # Write axis enablement register
-        # DEC(7-6) Z(5) Y(4) X(3) NON(2-0)
-        self.write(Accelerometer.AXIS_ENABLE_REGISTER, 0b00111000)
-
-        # Write output config register
-        # ODR(7-5) FULLSCALE(4-3) BWTOGGLE(2) BWVAL(1-0)
-        self.write(Accelerometer.OUTPUT_CONFIG_REGISTER, 0b00100000)
+        self.configure(Accelerometer.SETTINGS)
 
     def readX(self):
         return convert(self.readBlock(Accelerometer.X_REGISTER, 2), False)
@@ -69,21 +225,23 @@ class Accelerometer(Sensor):
     def readZ(self):
         return convert(self.readBlock(Accelerometer.Z_REGISTER, 2), False)
 
+    def readXYZ(self):
+        return convertXYZ(self.readBlock(Accelerometer.X_REGISTER, 6))
+
     def getNormalized(self):
-        x = self.readX()
-        y = self.readY()
-        z = self.readZ()
+        x, y, z = self.readXYZ()
 
         divisor = math.sqrt(x**2 + y**2 + z**2)
-        xNorm = self.readX() / divisor
-        yNorm = self.readY() / divisor
+        xNorm = x / divisor
+        yNorm = y / divisor
 
         return [xNorm, yNorm]
 
     def __str__(self):
-        x = self.readX()
-        y = self.readY()
-        z = self.readZ()
+        return self.format(self.readXYZ())
+
+    def format(self, xyz):
+        x, y, z = xyz
 
         angleX = math.degrees(math.atan2(y, z))
         angleY = math.degrees(math.atan2(z, x) + math.pi)
@@ -97,7 +255,7 @@ class Accelerometer(Sensor):
         output += "Accel Angle\tX: %.2f\t Y: %.2f\n" % (angleX, angleY)
         return output
 
-class Gyroscope(Sensor):
+class Gyroscope(InertialSensor):
     AXIS_ENABLE_REGISTER = 0x1E
     OUTPUT_CONFIG_REGISTER = 0x10
     ORIENTATION_REGISTER = 0x13
@@ -106,24 +264,38 @@ class Gyroscope(Sensor):
     Y_REGISTER = 0x1A
     Z_REGISTER = 0x1C
 
+    DATA_READY = 0b00000010
+
     GAIN = 0.070
-    TIME = datetime.datetime.now()
 
-    def __init__(self, bus):
-        Sensor.__init__(self, bus, 0x6A, 0x68, "Gyroscope")
+    # Output data rate in Hz for each ODR field of OUTPUT_CONFIG_REGISTER, 0 is power down.
+    # The accelerometer runs at the same rate while the gyro is on.
+    ODR = [0, 14.9, 59.5, 119, 238, 476, 952, 0]
 
-    def initialize(self):
-        # Write axis enablement register
+    SETTINGS = {
+        # Axis enablement register
         # NON(7-6) Z(5) Y(4) X(3) NON(2) LIR(1) 4D(0)
-        self.write(Gyroscope.AXIS_ENABLE_REGISTER, 0b00111000)
+        AXIS_ENABLE_REGISTER: 0b00111000,
 
-        # Write output config register
+        # Output config register
         # ODR(7-5) FULLSCALE(4-3) NON(2) BWVAL(1-0)
-        self.write(Gyroscope.OUTPUT_CONFIG_REGISTER, 0b10111000)
+        OUTPUT_CONFIG_REGISTER: 0b10111000,
 
-        # Write orientation register
+        # Orientation register
         # NON(7-6) X(5) Y(4) Z(3) ORIENT(2-0)
-        self.write(Gyroscope.ORIENTATION_REGISTER, 0b00111000)
+        ORIENTATION_REGISTER: 0b00111000,
+    }
+
+    def __init__(self, bus):
+        Sensor.__init__(self, bus, 0x6A, 0x68, "Gyroscope")
+        self.angle = [0.0, 0.0, 0.0]
+        self.lastTime = None
+
+    def initialize(self):
+        self.configure(Gyroscope.SETTINGS)
+
+    def odr(self):
+        return Gyroscope.ODR[self.register(Gyroscope.OUTPUT_CONFIG_REGISTER) >> 5]
 
     def readX(self):
         return convert(self.readBlock(Gyroscope.X_REGISTER, 2), False)
@@ -134,284 +306,613 @@ class Gyroscope(Sensor):
     def readZ(self):
         return convert(self.readBlock(Gyroscope.Z_REGISTER, 2), False)
 
-    def __str__(self):
-        diff = datetime.datetime.now() - Gyroscope.TIME
-        diff = diff.microseconds / (1000000 * 1.0)
-        Gyroscope.TIME = datetime.datetime.now()
+    def readXYZ(self):
+        return convertXYZ(self.readBlock(Gyroscope.X_REGISTER, 6))
 
-        x = self.readX()
-        y = self.readY()
-        z = self.readZ()
+    def __str__(self):
+        xyz = self.readXYZ()
+        return self.format(xyz, self.timestamp)
 
-        rateX = x * Gyroscope.GAIN
-        rateY = y * Gyroscope.GAIN
-        rateZ = z * Gyroscope.GAIN
+    def integrate(self, xyz, timestamp):
+        # Adds rate * dt to the angle, with dt taken from the monotonic read timestamps
+        if self.lastTime is not None and timestamp > self.lastTime:
+            dt = clock.seconds(timestamp - self.lastTime)
+            self.angle = [angle + rate * Gyroscope.GAIN * dt for angle, rate in zip(self.angle, xyz)]
+        self.lastTime = timestamp
+        return self.angle
 
-        angleX = rateX * diff
-        angleY = rateY * diff
-        angleZ = rateZ * diff
+    def format(self, xyz, timestamp):
+        x, y, z = xyz
+        angleX, angleY, angleZ = self.integrate(xyz, timestamp)
 
         output = "Gyro Raw\tX: %.2f\t Y: %.2f\t Z: %.2f\n" % (x, y, z)
         output += "Gyro Angle\tX: %.2f\t Y: %.2f\t Z: %.2f\n" % (angleX, angleY, angleZ)
         return output
 
 class Magnetometer(Sensor):
-    X_MIN = 32767
-    Y_MIN = 32767
-    Z_MIN = 32767
-    X_MAX = -32767
-    Y_MAX = -32767
-    Z_MAX = -32767
-
     OUTPUT_CONFIG_REGISTER = 0x20
     SCALE_CONFIG_REGISTER = 0x21
     MODE_CONFIG_REGISTER = 0x22
     Z_MODE_CONFIG_REGISTER = 0x23
+    STATUS_REGISTER = 0x27
 
     X_REGISTER = 0x28
     Y_REGISTER = 0x2A
     Z_REGISTER = 0x2C
 
-    def __init__(self, bus):
-        Sensor.__init__(self, bus, 0x1C, 0x3D, "Magnetometer")
+    # Sub-address MSB enables register auto-increment on multi-byte transfers
+    AUTO_INCREMENT = 0x80
 
-    def initialize(self):
-        # Write x/y output config register
+    # CTRL_REG1_M through CTRL_REG5_M
+    CONTROL_BLOCKS = [(0x20, 0x05)]
+
+    DATA_READY = 0b00001000
+    OVERRUN = 0b10000000
+
+    # Output data rate in Hz for each ODR field of OUTPUT_CONFIG_REGISTER, and with FASTODR set
+    # for each performance mode, from low power to ultra-high
+    ODR = [0.625, 1.25, 2.5, 5, 10, 20, 40, 80]
+    FAST_ODR = [1000, 560, 300, 155]
+
+    # Calibration collects min/max for this many seconds, reading at the 80 Hz ODR
+    CALIBRATION_TIME = 5
+    # Asked for with --calibrate, long enough to turn the device through every direction
+    RECALIBRATION_TIME = 60
+    CALIBRATION_INTERVAL = 1.0 / 80
+
+    SETTINGS = {
+        # X/Y output config register
         # TEMPCOMP(7) MODE(6-5) ODR(4-2) FASTODR(1) TEST(0)
-        self.write(Magnetometer.OUTPUT_CONFIG_REGISTER, 0b10111100)
-        
-        # Write scale config register
+        OUTPUT_CONFIG_REGISTER: 0b10111100,
+
+        # Scale config register
         # NON(7) FULLSCALE(6-5) NON(4) REBOOT(3) SOFTRESET(2) NON(1-0)
-        self.write(Magnetometer.SCALE_CONFIG_REGISTER, 0b01000000)
+        SCALE_CONFIG_REGISTER: 0b01000000,
 
-        # Write system operating mode config register
+        # System operating mode config register
         # NON(7-6) LOWPOWERMODE(5) NON(4-2) MODE(1-0)
-        self.write(Magnetometer.MODE_CONFIG_REGISTER, 0b00000000)
+        MODE_CONFIG_REGISTER: 0b00000000,
 
-        # Write z-axis operating mode config register
+        # Z-axis operating mode config register
         # NON(7-4) Z-MODE(3-2) BLE(1) NON(0)
-        self.write(Magnetometer.Z_MODE_CONFIG_REGISTER, 0b00000000)
-
-        startTime = int(round(time() * 1000))
-        while startTime + 5000 > int(round(time() * 1000)):
-            x = convert(self.readBlock(Magnetometer.X_REGISTER, 2), False)
-            y = convert(self.readBlock(Magnetometer.Y_REGISTER, 2), False)
-            z = convert(self.readBlock(Magnetometer.Z_REGISTER, 2), False)
-
-            if x > Magnetometer.X_MAX:
-                Magnetometer.X_MAX = x
-            if y > Magnetometer.Y_MAX:
-                Magnetometer.Y_MAX = y
-            if z > Magnetometer.Z_MAX:
-                Magnetometer.Z_MAX = z
-            if x < Magnetometer.X_MIN:
-                Magnetometer.X_MIN = x
-            if y < Magnetometer.Y_MIN:
-                Magnetometer.Y_MIN = y
-            if z < Magnetometer.Z_MIN:
-                Magnetometer.Z_MIN = z
-
-        print("Calibrated Magnet\tX: %.2f - %.2f\t Y: %.2f - %.2f\t Z: %.2f - %.2f\n" %
-                                                                    (Magnetometer.X_MIN, Magnetometer.X_MAX,
-                                                                     Magnetometer.Y_MIN, Magnetometer.Y_MAX,
-                                                                     Magnetometer.Z_MIN, Magnetometer.Z_MAX))
-        sleep(1)
+        Z_MODE_CONFIG_REGISTER: 0b00000000,
+    }
+
+    def __init__(self, bus):
+        Sensor.__init__(self, bus, 0x1C, 0x3D, "Magnetometer")
+        self.key = "0x%02X" % self.address
+        self.store = None
+        self.profile = None
+        self.calibrator = None
+
+    def initialize(self, store=None, recalibrate=False):
+        # Loads the stored calibration profile, only blocking to calibrate when there is none or when asked to.
+        # A stale profile is used as is while a fresh one is collected in the background.
+        self.configure(Magnetometer.SETTINGS)
+        self.store = store
+
+        profile = store.load(self.key) if store is not None else None
+        if profile is not None:
+            self.apply(profile)
+        if profile is None or recalibrate:
+            self.calibrate(Magnetometer.RECALIBRATION_TIME if recalibrate else Magnetometer.CALIBRATION_TIME,
+                           recalibrate)
+        else:
+            print("Loaded Magnet calibration\t%s\n" % profile)
+            if profile.stale():
+                self.calibrateInBackground()
+
+    def odr(self):
+        value = self.register(Magnetometer.OUTPUT_CONFIG_REGISTER)
+        if value & 0b10:
+            return Magnetometer.FAST_ODR[(value >> 5) & 0b11]
+        return Magnetometer.ODR[(value >> 2) & 0b111]
+
+    def apply(self, profile):
+        self.profile = profile
+
+    def collect(self, duration):
+        # Stops early once the device has been turned through every direction
+        collector = calibration.Collector()
+        deadline = clock.monotonic() + duration
+        while clock.monotonic() < deadline and not collector.complete() and not collector.full():
+            collector.add(self.readRawXYZ())
+            sleep(Magnetometer.CALIBRATION_INTERVAL)
+        return collector
+
+    def calibrate(self, duration=CALIBRATION_TIME, replace=False):
+        # An incomplete calibration is neither used nor saved: its offset can be far off, and a saved profile
+        # would be reused for MAX_AGE
+        collector = self.collect(duration)
+        if not collector.complete():
+            print("Magnet calibration incomplete (%d%% of directions covered), %s\n" % (
+                collector.coverage() * 100,
+                "keeping the stored profile" if self.profile is not None else
+                "readings are uncorrected. Rotate the device through every direction with --calibrate"))
+            return False
+
+        profile = collector.profile()
+        # A background refresh only replaces the old profile if the device moved about as much as last time
+        if self.profile is not None and not replace and not profile.covers(self.profile):
+            print("Magnet calibration discarded, the device was not rotated enough\n")
+            return False
+
+        self.apply(profile)
+        if self.store is not None:
+            self.store.save(self.key, profile)
+        print("Calibrated Magnet\t%s\n" % profile)
+        return True
+
+    def calibrateInBackground(self, duration=CALIBRATION_TIME):
+        if self.calibrator is not None and self.calibrator.is_alive():
+            return
+        self.calibrator = threading.Thread(target=self.calibrate, args=(duration,))
+        self.calibrator.daemon = True
+        self.calibrator.start()
 
     def readX(self):
-        x = convert(self.readBlock(Magnetometer.X_REGISTER, 2), False)
-        x -= (Magnetometer.X_MIN + Magnetometer.X_MAX) / 2
-        return x
+        return self.readXYZ()[0]
 
     def readY(self):
-        y = convert(self.readBlock(Magnetometer.Y_REGISTER, 2), False)
-        y -= (Magnetometer.Y_MIN + Magnetometer.Y_MAX) / 2
-        return y
+        return self.readXYZ()[1]
 
     def readZ(self):
-        z = convert(self.readBlock(Magnetometer.Z_REGISTER, 2), False)
-        z -= (Magnetometer.Z_MIN + Magnetometer.Z_MAX) / 2
-        return z
+        return self.readXYZ()[2]
+
+    def readStatus(self):
+        # (new data, overrun) from STATUS_REG_M
+        status = self.read(Magnetometer.STATUS_REGISTER)
+        return bool(status & Magnetometer.DATA_READY), bool(status & Magnetometer.OVERRUN)
+
+    def readRawXYZ(self):
+        return convertXYZ(self.readBlock(Magnetometer.X_REGISTER | Magnetometer.AUTO_INCREMENT, 6))
+
+    def readXYZ(self):
+        return self.correct(self.readRawXYZ())
+
+    def correct(self, xyz):
+        if self.profile is None:
+            return list(xyz)
+        return self.profile.correct(xyz)
 
     def __str__(self):
-        return "Magnet Raw\tX: %.2f\t Y: %.2f\t Z: %.2f\n" % (self.readX(), self.readY(), self.readZ())
+        return self.format(self.readXYZ())
+
+    def format(self, xyz):
+        return "Magnet Raw\tX: %.2f\t Y: %.2f\t Z: %.2f\n" % tuple(xyz)
+
+class IMUSample(namedtuple("IMUSample", ["acc", "gyr", "mag", "time"])):
+    # time is the clock.monotonic_ns() of the read that produced the newest of the values
 
-class IMU():
     DIRECTIONS = ["N", "NE",
                   "E", "SE",
                   "S", "SW",
                   "W", "NW"]
 
-    def __init__(self, bus):
-        self.acc = Accelerometer(bus)
-        self.gyr = Gyroscope(bus)
-        self.mag = Magnetometer(bus)
-
-    def detect(self):
-        self.acc.detect()
-        self.gyr.detect()
-        self.mag.detect()
-
-    def initialize(self):
-        self.acc.initialize()
-        self.gyr.initialize()
-        self.mag.initialize()
+    __slots__ = ()
 
     def getPitch(self):
+        x, y, z = self.acc
         try:
-            return math.asin(self.acc.getNormalized()[0])
-        except ValueError:
+            return math.asin(x / math.sqrt(x**2 + y**2 + z**2))
+        except (ValueError, ZeroDivisionError):
             return 0
 
     def getRoll(self):
+        x, y, z = self.acc
         try:
-            return -math.asin(self.acc.getNormalized()[1] / math.cos(self.getPitch()))
-        except ValueError:
+            return -math.asin(y / math.sqrt(x**2 + y**2 + z**2) / math.cos(self.getPitch()))
+        except (ValueError, ZeroDivisionError):
             return 0
 
     def getHeading(self, compensated):
-        magX = self.mag.readX()
-        magY = self.mag.readY()
+        magX, magY, magZ = self.mag
 
         if compensated:
-            magZ = self.mag.readZ()
             pitch = self.getPitch()
             roll = self.getRoll()
 
-            magX = magX * math.cos(pitch) + magZ * math.sin(pitch)
-            magY = magX * math.sin(roll) * math.sin(pitch) + magY * math.cos(roll) + magZ * math.sin(roll) * math.cos(pitch)
+            compX = magX * math.cos(pitch) + magZ * math.sin(pitch)
+            compY = magX * math.sin(roll) * math.sin(pitch) + magY * math.cos(roll) + magZ * math.sin(roll) * math.cos(pitch)
+            magX, magY = compX, compY
 
         heading = 180 * math.atan2(magY, magX) / math.pi
         return heading if heading >= 0 else heading + 360
 
     def getDirection(self):
         heading = self.getHeading(True)
-        try:
-            return IMU.DIRECTIONS[int(round(heading / 45)) - 1]
-        except IndexError:
-            print(int(round(heading / 45)) - 1)
-            return ""
+        return IMUSample.DIRECTIONS[int(round(heading / 45)) % len(IMUSample.DIRECTIONS)]
 
-    def __str__(self):
-        output = str(self.acc) + "\n" + str(self.gyr) + "\n" + str(self.mag) + "\n"
-        output += "Pitch: %.2f\n" % self.getPitch()
-        output += "Roll: %.2f\n" % self.getRoll()
-        output += "Heading: %.2f\n" % self.getHeading(False)
-        output += "Compensated Heading: %.2f\n" % self.getHeading(True)
-        output += "Direction: %s\n" % self.getDirection()
+class IMU():
+    POLL_INTERVAL = 0.0005
+
+    # Gyro (0x18-0x1D) through accel (0x28-0x2D) output registers, read as one auto-increment block
+    INERTIAL_BLOCK = Accelerometer.X_REGISTER + 6 - Gyroscope.X_REGISTER
+
+    def __init__(self, bus):
+        self.acc = Accelerometer(bus)
+        self.gyr = Gyroscope(bus)
+        self.mag = Magnetometer(bus)
+        self.fifoOverruns = 0
+        self.latest = None
+        self.skipped = 0
+        self.overruns = 0
+        self.sampler = None
+        self.timestamp = None
+
+    def detect(self):
+        self.acc.detect()
+        self.gyr.detect()
+        self.mag.detect()
+
+    def initialize(self, store=None, recalibrate=False):
+        # Accel and gyro share one device, configuring them together lets their registers share block writes
+        settings = dict(Accelerometer.SETTINGS)
+        settings.update(Gyroscope.SETTINGS)
+        self.gyr.configure(settings)
+        self.mag.initialize(store, recalibrate)
+
+    def sample(self):
+        acc, gyr, mag = self.readRaw()
+        return IMUSample(acc, gyr, self.mag.correct(mag), self.timestamp)
+
+    def readRaw(self):
+        # The read's timestamp is left in self.timestamp
+        inertial, mag = readBlocks(self.gyr.bus, [[self.gyr, Gyroscope.X_REGISTER, IMU.INERTIAL_BLOCK],
+                                                  [self.mag, Magnetometer.X_REGISTER | Magnetometer.AUTO_INCREMENT, 6]])
+        self.timestamp = self.gyr.timestamp
+        return [convertXYZ(inertial[-6:]), convertXYZ(inertial[:6]), convertXYZ(mag)]
+
+    def readInertial(self):
+        # Accel and gyro only, for reading them at their own rate. The timestamp is left in self.timestamp.
+        inertial = self.gyr.readBlock(Gyroscope.X_REGISTER, IMU.INERTIAL_BLOCK)
+        self.timestamp = self.gyr.timestamp
+        return [convertXYZ(inertial[-6:]), convertXYZ(inertial[:6])]
+
+    def inertialReady(self):
+        # STATUS_REG flags a new accel or gyro sample since the output registers were last read
+        status = self.gyr.read(InertialSensor.STATUS_REGISTER)
+        return bool(status & (Accelerometer.DATA_READY | Gyroscope.DATA_READY))
+
+    def build(self, values, timestamp):
+        # Builds a sample from the nine raw axes stored by the sampler
+        return IMUSample(values[0:3], values[3:6], self.mag.correct(values[6:9]), timestamp)
+
+    def startSampler(self, rate=None, capacity=1024, pressure=None, log=None, mode=sampler.Sampler.ODR):
+        self.sampler = sampler.Sampler(self, rate, capacity, pressure, log, mode)
+        self.sampler.start()
+
+    def stopSampler(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler = None
+
+    def current(self):
+        # With a sampler running, answer from its buffer instead of the bus
+        if self.sampler is not None:
+            sample = self.sampler.latest()
+            if sample is not None:
+                return sample
+        return self.sample()
+
+    def poll(self):
+        # Read STATUS_REG and STATUS_REG_M and only read the axis groups flagged as new.
+        # Returns None when nothing new has arrived since the last poll.
+        # STATUS_REG has no overrun flag, so only magnetometer overruns can be counted.
+        with self.gyr.exclusive(), self.mag.exclusive():
+            status = self.gyr.read(InertialSensor.STATUS_REGISTER)
+            magStatus = self.mag.read(Magnetometer.STATUS_REGISTER)
+
+            if magStatus & Magnetometer.OVERRUN:
+                self.overruns += 1
+
+            accReady = status & Accelerometer.DATA_READY
+            gyrReady = status & Gyroscope.DATA_READY
+            magReady = magStatus & Magnetometer.DATA_READY
+
+            if self.latest is None:
+                self.latest = self.sample()
+                return self.latest
+
+            if not (accReady or gyrReady or magReady):
+                self.skipped += 1
+                return None
+
+            acc, gyr, mag, timestamp = self.latest
+            if accReady:
+                acc = self.acc.readXYZ()
+                timestamp = self.acc.timestamp
+            if gyrReady:
+                gyr = self.gyr.readXYZ()
+                timestamp = self.gyr.timestamp
+            if magReady:
+                mag = self.mag.readXYZ()
+                timestamp = self.mag.timestamp
+
+            self.latest = IMUSample(acc, gyr, mag, timestamp)
+            return self.latest
+
+    def waitSample(self, timeout=None):
+        start = clock.monotonic()
+        while True:
+            sample = self.poll()
+            if sample is not None:
+                return sample
+            if timeout is not None and clock.monotonic() - start > timeout:
+                return None
+            sleep(IMU.POLL_INTERVAL)
+
+    def enableFIFO(self):
+        self.gyr.enableFIFO()
+
+    def disableFIFO(self):
+        self.gyr.disableFIFO()
+
+    def drainFIFO(self):
+        # Raw (timestamp, acc, gyr) of every sample waiting in the FIFO, oldest first. Each slot is read as
+        # the one gyro through accel output block, which pops it.
+        with self.gyr.exclusive():
+            count, overrun = self.gyr.readFIFOStatus()
+            # The newest slot was filled just before FIFO_SRC was read, the drain itself comes later
+            newest = self.gyr.timestamp
+            if overrun:
+                self.fifoOverruns += 1
+
+            slots = []
+            for i in range(min(count, InertialSensor.FIFO_DEPTH)):
+                inertial = self.gyr.readBlock(Gyroscope.X_REGISTER, IMU.INERTIAL_BLOCK)
+                slots.append([convertXYZ(inertial[-6:]), convertXYZ(inertial[:6])])
+
+        # Slots were filled one ODR period apart
+        period = int(clock.NANOSECONDS / self.gyr.odr())
+        return [(newest - (len(slots) - 1 - i) * period, acc, gyr) for i, (acc, gyr) in enumerate(slots)]
+
+    def readFIFO(self):
+        # The magnetometer has no FIFO, so every drained sample shares its latest reading
+        samples = self.drainFIFO()
+        if not samples:
+            return []
+        mag = self.mag.readXYZ()
+        return [IMUSample(acc, gyr, mag, timestamp) for timestamp, acc, gyr in samples]
+
+    def getPitch(self):
+        return self.current().getPitch()
+
+    def getRoll(self):
+        return self.current().getRoll()
+
+    def getHeading(self, compensated):
+        return self.current().getHeading(compensated)
+
+    def getDirection(self):
+        return self.current().getDirection()
+
+    def format(self, sample):
+        output = self.acc.format(sample.acc) + "\n" + self.gyr.format(sample.gyr, sample.time) + "\n" + self.mag.format(sample.mag) + "\n"
+        output += "Pitch: %.2f\n" % sample.getPitch()
+        output += "Roll: %.2f\n" % sample.getRoll()
+        output += "Heading: %.2f\n" % sample.getHeading(False)
+        output += "Compensated Heading: %.2f\n" % sample.getHeading(True)
+        output += "Direction: %s\n" % sample.getDirection()
         return output
 
+    def __str__(self):
+        return self.format(self.current())
+
 class Pressure(Sensor):
+    # BMP280 driver. Each instance is one chip, at 0x77 (SDO high, as on the BerryIMU) or 0x76.
+    #
+    # In normal mode the chip converts continuously, one measurement per standby period. In forced mode it
+    # sleeps until a read starts a single conversion. Either way one conversion gives both temperature and
+    # pressure, and reads within the standby period return that last result.
+    ADDRESSES = [0x77, 0x76]
+
+    STATUS_REGISTER = 0xF3
     CTRL_MEAS_REGISTER = 0xF4
     CONFIG_REGISTER = 0xF5
-
-    initialized = False
-    trim = {}
-    data = []
-    fineTemperature = 0
-    finePressure = 0
-    lastRead = 0
-
-    def __init__(self, bus, name):
-        Sensor.__init__(self, bus, 0x77, 0x58, name)
+    TRIM_REGISTER = 0x88
+    DATA_REGISTER = 0xF7
+
+    CONTROL_BLOCKS = [(0xF4, 0x02)]
+
+    MEASURING = 0b00001000
+
+    SLEEP_MODE = 0b00
+    FORCED_MODE = 0b01
+    NORMAL_MODE = 0b11
+
+    # Oversampling factor or IIR filter coefficient to register field
+    OVERSAMPLING = {0: 0, 1: 1, 2: 2, 4: 3, 8: 4, 16: 5}
+    FILTER = {0: 0, 2: 1, 4: 2, 8: 3, 16: 4}
+    # Normal mode standby time in ms to register field
+    STANDBY = {0.5: 0, 62.5: 1, 125: 2, 250: 3, 500: 4, 1000: 5, 2000: 6, 4000: 7}
+
+    # Temperature oversampling, pressure oversampling and IIR filter coefficient, from the datasheet's
+    # recommended settings. Higher resolution costs conversion time and current for less noise.
+    PROFILES = {
+        "ultra-low-power": (1, 1, 0),
+        "low-power": (1, 2, 0),
+        "standard": (1, 4, 16),
+        "high-res": (1, 8, 16),
+        "ultra-high-res": (2, 16, 16),
+    }
+
+    def __init__(self, bus, address=0x77, profile="standard", forced=False, standby=1000, name="Pressure"):
+        Sensor.__init__(self, bus, address, 0x58, name)
         self.idRegister = 0xD0
+        self.temperatureOversampling, self.pressureOversampling, self.filter = Pressure.PROFILES[profile]
+        self.forced = forced
+        self.standby = standby
+        self.trim = None
+        self.fineTemperature = 0
+        self.temperature = 0
+        self.finePressure = 0
+        self.result = (0, 0)
+        self.lastRead = None
+        # A running Sampler keeps the last result up to date, and reads are served from it
+        self.sampler = None
+
+    def controlMeasurement(self, mode):
+        # Control measurement register
+        # TEMP(7-5) PRES(4-2) MODE(1-0)
+        return (Pressure.OVERSAMPLING[self.temperatureOversampling] << 5 |
+                Pressure.OVERSAMPLING[self.pressureOversampling] << 2 | mode)
 
     def initialize(self):
-        if not Pressure.initialized:
-            Pressure.initialized = True
-            self.readTrim()
-            # Write control measurement register
-            # TEMP(7-5) PRES(4-2) MODE(1-0)
-            # 0x27 = 001 001 11
-            # 0x2F = 001 011 11
-            # 0x4F = 010 011 11
-            self.write(Pressure.CTRL_MEAS_REGISTER, 0x2F)
-            # Write config register
-            # STBY(7-5) FLTR(4-2) SPIW(0)
-            # 0xA0 = 101 000 00
-            # 0xB0 = 101 100 00
-            self.write(Pressure.CONFIG_REGISTER, 0xB0)
-        
+        self.readTrim()
+        # Config register
+        # STBY(7-5) FLTR(4-2) SPIW(0)
+        config = Pressure.STANDBY[self.standby] << 5 | Pressure.FILTER[self.filter] << 2
+        # Writes to config may be ignored in normal mode, which the chip keeps across restarts,
+        # so a new config goes in while it sleeps
+        if self.register(Pressure.CONFIG_REGISTER) != config:
+            self.configure({Pressure.CTRL_MEAS_REGISTER: self.controlMeasurement(Pressure.SLEEP_MODE)})
+            self.configure({Pressure.CONFIG_REGISTER: config})
+        self.configure({
+            Pressure.CTRL_MEAS_REGISTER: self.controlMeasurement(Pressure.SLEEP_MODE if self.forced else Pressure.NORMAL_MODE),
+        })
+
         Sensor.initialize(self)
 
+    def measurementTime(self):
+        # Maximum conversion time in seconds from the datasheet, 13.3 ms in the standard profile
+        milliseconds = 1.25 + 2.3 * self.temperatureOversampling
+        if self.pressureOversampling:
+            milliseconds += 2.3 * self.pressureOversampling + 0.575
+        return milliseconds / 1000.0
+
+    def measure(self):
+        # Starts one forced conversion and waits for it
+        with self.exclusive():
+            self.startMeasurement()
+            sleep(self.measurementTime())
+            while self.read(Pressure.STATUS_REGISTER) & Pressure.MEASURING:
+                sleep(0.0005)
+
+    def startMeasurement(self):
+        # Starts one forced conversion without waiting, its result can be read measurementTime() later.
+        # The chip drops back to sleep mode on its own, so this always writes instead of going through
+        # the shadow cache.
+        self.write(Pressure.CTRL_MEAS_REGISTER, self.controlMeasurement(Pressure.FORCED_MODE))
+        self.shadow()[Pressure.CTRL_MEAS_REGISTER] = self.controlMeasurement(Pressure.SLEEP_MODE)
+
+    def readMeasurement(self):
+        # The uncompensated (adc_T, adc_P) of the last conversion
+        return bmp280.split(self.readBlock(Pressure.DATA_REGISTER, 6))
+
+    def period(self):
+        # Seconds between new results. In normal mode a cycle is the conversion plus the standby time,
+        # forced mode has no rhythm of its own so reading once per standby period keeps the same pace.
+        if self.forced:
+            return self.standby / 1000.0
+        return self.measurementTime() + self.standby / 1000.0
+
+    def writeBlock(self, register, values):
+        # The BMP280 doesn't auto-increment on writes, a multi-byte write is a sequence of register/value pairs
+        data = [values[0]]
+        for offset, value in enumerate(values[1:]):
+            data += [register + offset + 1, value]
+        Sensor.writeBlock(self, register, data)
+
     def readTrim(self):
-        block = self.readBlock(0x88, 24)
-
-        Pressure.trim["T1"] = convert([block[0], block[1]], True)
-        Pressure.trim["T2"] = convert([block[2], block[3]], False)
-        Pressure.trim["T3"] = convert([block[4], block[5]], False)
-
-        Pressure.trim["P1"] = convert([block[6], block[7]], True)
-        Pressure.trim["P2"] = convert([block[8], block[9]], False)
-        Pressure.trim["P3"] = convert([block[10], block[11]], False)
-        Pressure.trim["P4"] = convert([block[12], block[13]], False)
-        Pressure.trim["P5"] = convert([block[14], block[15]], False)
-        Pressure.trim["P6"] = convert([block[16], block[17]], False)
-        Pressure.trim["P7"] = convert([block[18], block[19]], False)
-        Pressure.trim["P8"] = convert([block[20], block[21]], False)
-        Pressure.trim["P9"] = convert([block[22], block[23]], False)
+        self.trim = bmp280.Trim.unpack(self.readBlock(Pressure.TRIM_REGISTER, bmp280.TRIM.size))
 
     def readData(self):
-        currTime = int(round(time() * 1000))
-        # BMP Sensor Standby set to 1000ms
-        if Pressure.lastRead + 1000 < currTime:
-            Pressure.data = self.readBlock(0xF7, 8)
-
-            adc_t = ((Pressure.data[3] * 65536) + (Pressure.data[4] * 256) + (Pressure.data[5] & 0xF0)) / 16
-            var1 = (adc_t / 16384.0 - Pressure.trim["T1"] / 1024.0) * Pressure.trim["T2"]
-            var2 = ((adc_t / 131072.0 - Pressure.trim["T1"] / 8192.0) * (adc_t / 131072.0 - Pressure.trim["T1"] / 8192.0)) * Pressure.trim["T3"]
-            Pressure.fineTemperature = var1 + var2
-
-            adc_p = ((Pressure.data[0] * 65536) + (Pressure.data[1] * 256) + (Pressure.data[2] & 0xF0)) / 16
-            var1 = (Pressure.fineTemperature / 2.0) - 64000.0
-            var2 = var1 * var1 * Pressure.trim["P6"] / 32768.0
-            var2 = var2 + var1 * Pressure.trim["P5"] * 2.0
-            var2 = (var2 / 4.0) + (Pressure.trim["P4"] * 65536.0)
-            var1 = (Pressure.trim["P3"] * var1 * var1 / 524288.0 + Pressure.trim["P2"] * var1) / 524288.0
-            var1 = (1.0 + var1 / 32768.0) * Pressure.trim["P1"]
-            p = 1048576.0 - adc_p
-            p = (p - (var2 / 4096.0)) * 6250.0 / var1
-            var1 = (Pressure.trim["P9"]) * p * p / 2147483648.0
-            var2 = p * Pressure.trim["P8"] / 32768.0
-            Pressure.finePressure = p + (var1 + var2 + Pressure.trim["P7"]) / 16.0
-
-            Pressure.lastRead = currTime
-
-class Thermometer(Pressure):
-    def __init__(self, bus):
-        Pressure.__init__(self, bus, "Thermometer")
+        # Returns the (temperature, pressure) pair of one conversion, in degrees Celsius and Pascal. In normal
+        # mode the result only changes once per standby period, and forced mode converts at most that often,
+        # so reads within it are served from the last one.
+        if self.sampler is None and (self.lastRead is None or
+                                     clock.monotonic_ns() - self.lastRead >= self.standby * 1000000):
+            self.compensate(*self.readRaw())
+        return self.result
+
+    def compensate(self, adcT, adcP):
+        self.fineTemperature, temperature = bmp280.compensateTemperature(self.trim, adcT)
+        self.temperature = temperature / 100.0
+        self.finePressure = bmp280.compensatePressure(self.trim, adcP, self.fineTemperature) / 256.0
+        # Set in one go, for readers on other threads
+        self.result = (self.temperature, self.finePressure)
+
+        # Time of the data read, the conversion itself finished somewhat earlier
+        self.lastRead = self.timestamp
+
+    def readRaw(self):
+        # Returns the uncompensated (adc_T, adc_P), converting first in forced mode
+        if self.forced:
+            self.measure()
+        return self.readMeasurement()
 
     def readTemperature(self):
-        self.readData()
-        cTemp = Pressure.fineTemperature / 5120.0
+        # Degrees Celsius
+        return self.readData()[0]
+
+    def readPressure(self):
+        # Pascal
+        return self.readData()[1]
+
+def detectPressure(bus, **options):
+    # Returns a Pressure driver for every BMP280 that answers on the bus
+    sensors = []
+    for address in Pressure.ADDRESSES:
+        sensor = Pressure(bus, address, **options)
+        try:
+            sensor.detect()
+        except (SensorError, IOError):
+            continue
+        sensors.append(sensor)
+    return sensors
+
+class Thermometer():
+    def __init__(self, pressure):
+        self.pressure = pressure
+
+    def readTemperature(self):
+        cTemp = self.pressure.readTemperature()
         return cTemp * 1.8 + 32
 
     def __str__(self):
         return "Temperature: %.2f F\n" % self.readTemperature()
 
-class Barometer(Pressure):
-    def __init__(self, bus):
-        Pressure.__init__(self, bus, "Barometer")
+class Barometer():
+    def __init__(self, pressure):
+        self.pressure = pressure
 
     def readPressure(self):
-        self.readData()
-        return Pressure.finePressure / 100
+        return self.pressure.readPressure() / 100
 
     def __str__(self):
         return "Pressure: %.2f hPa\n" % self.readPressure()
 
-class Altimeter(Pressure):
-    def __init__(self, bus):
-        Pressure.__init__(self, bus, "Altimeter")
+class Altimeter():
+    def __init__(self, pressure, seaLevel=altitude.SEA_LEVEL):
+        self.pressure = pressure
+        self.seaLevel = seaLevel
+        self.verticalSpeed = altitude.VerticalSpeed()
+        self.lastRead = None
+        # Not a number until the first conversion
+        self.altitude = float("nan")
 
     def readAltitude(self):
-        self.readData()
-        cTemp = Pressure.fineTemperature / 5120.0
-        hpaPres = Pressure.finePressure / 100
-        mAlt = ((((1013.25 / hpaPres) ** (1 / 5.257)) - 1) * (cTemp + 273.15)) / 0.0065
-        return mAlt * 3.281
+        # Metres above the sea level reference. Each new pressure sample also feeds the vertical speed filter.
+        # Temperature and pressure come from the same conversion.
+        cTemp, pressure = self.pressure.readData()
+        # A sampler whose first conversion failed has nothing but its placeholder yet
+        if self.pressure.lastRead is None or pressure <= 0:
+            return self.altitude
+        self.altitude = altitude.altitude(pressure, cTemp, self.seaLevel)
+        if self.pressure.lastRead != self.lastRead:
+            self.lastRead = self.pressure.lastRead
+            self.verticalSpeed.update(clock.seconds(self.lastRead), self.altitude)
+        return self.altitude
+
+    def readVerticalSpeed(self):
+        # Metres per second, smoothed
+        self.readAltitude()
+        return self.verticalSpeed.speed
 
     def __str__(self):
-        return "Altitude: %.2f ft\n" % self.readAltitude()
+        mAlt = self.readAltitude()
+        return "Altitude: %.2f ft\tVertical Speed: %.2f ft/min\n" % (mAlt * 3.281, self.verticalSpeed.speed * 3.281 * 60)
 
 class SensorError(Exception):
     def __init__(self, name):
@@ -0,0 +1,95 @@
+import sys
+import time
+import atexit
+
+clock = getattr(time, "perf_counter", time.time)
+
+# Latency histogram buckets in microseconds, the last bucket catches everything slower
+BUCKETS = [50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+enabled = False
+devices = {}
+
+class DeviceStats():
+    def __init__(self, address):
+        self.address = address
+        self.transactions = 0
+        self.bytes = 0
+        self.errors = 0
+        self.busyTime = 0.0
+        self.histogram = [0] * (len(BUCKETS) + 1)
+
+    def measure(self, size, function, *args):
+        start = clock()
+        try:
+            result = function(*args)
+        except IOError:
+            self.errors += 1
+            raise
+        finally:
+            self.record(size, clock() - start)
+        return result
+
+    def record(self, size, elapsed):
+        self.transactions += 1
+        self.bytes += size
+        self.busyTime += elapsed
+
+        micros = elapsed * 1000000
+        bucket = 0
+        while bucket < len(BUCKETS) and micros > BUCKETS[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+
+    def __str__(self):
+        output = "Device 0x%02X\tTransactions: %d\t Bytes: %d\t Errors: %d\t Bus Time: %.3f s\n" % (
+            self.address, self.transactions, self.bytes, self.errors, self.busyTime)
+        lower = 0
+        for upper, count in zip(BUCKETS + [None], self.histogram):
+            label = "%d-%d us" % (lower, upper) if upper is not None else ">%d us" % lower
+            output += "  %-14s %d\n" % (label, count)
+            lower = upper
+        return output
+
+def measureCombined(reads, function, *args):
+    # Times one combined transaction touching several devices. reads lists (address, size) per block,
+    # and every device involved counts it as one of its transactions.
+    start = clock()
+    failed = False
+    try:
+        return function(*args)
+    except IOError:
+        failed = True
+        raise
+    finally:
+        elapsed = clock() - start
+        for address, size in reads:
+            deviceStats = get(address)
+            if deviceStats is not None:
+                deviceStats.errors += failed
+                deviceStats.record(size, elapsed)
+
+def enable(dump=True):
+    global enabled
+    if dump and not enabled:
+        atexit.register(report)
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def get(address):
+    if not enabled:
+        return None
+    if address not in devices:
+        devices[address] = DeviceStats(address)
+    return devices[address]
+
+def reset():
+    devices.clear()
+
+def report(file=None):
+    file = file or sys.stderr
+    for address in sorted(devices):
+        file.write(str(devices[address]))
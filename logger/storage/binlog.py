@@ -0,0 +1,204 @@
+import json
+import struct
+import zlib
+
+# Binary sample log
+#
+# A file is a header followed by fixed-size blocks. Everything is little-endian.
+#
+# Header, HEADER_SIZE bytes (a multiple of BLOCK_SIZE):
+#   magic "IMULOG\0\0", version u16, header size u32, block size u32, record size u16, records per block u16,
+#   metadata length u32, then the metadata as UTF-8 JSON (calibration, register config, start time), zero padded
+#
+# Block, BLOCK_SIZE bytes, so every write is one aligned 4 KiB page on the SD card:
+#   magic "BLK0", record count u16, reserved u16, CRC-32 of the records u32, sequence of the first record u32,
+#   then up to RECORDS_PER_BLOCK records. Only the last block of a file may be partly filled, the rest is zeros.
+#
+# Record, RECORD_SIZE bytes:
+#   clock.monotonic_ns() of the accel/gyro read i64, accel xyz, gyro xyz, mag xyz i16 (raw register values),
+#   BMP280 adc_T u32, adc_P u32, flags u16, sequence u32
+
+MAGIC = b"IMULOG\0\0"
+VERSION = 1
+
+HEADER = struct.Struct("<8sHIIHHI")
+BLOCK_HEADER = struct.Struct("<4sHHII")
+RECORD = struct.Struct("<q9hIIHI")
+
+BLOCK_MAGIC = b"BLK0"
+BLOCK_SIZE = 4096
+RECORDS_PER_BLOCK = (BLOCK_SIZE - BLOCK_HEADER.size) // RECORD.size
+
+INDEX_MAGIC = b"IMUIDX\0\0"
+INDEX_SUFFIX = ".idx"
+INDEX_HEADER = struct.Struct("<8sHHI")
+INDEX_ENTRY = struct.Struct("<qQQ")
+
+# About 2 s at 476 Hz, so a week of samples takes under 7 MB of index
+INDEX_INTERVAL = 1024
+
+# Index side file, LOG + INDEX_SUFFIX:
+#   magic "IMUIDX\0\0", version u16, reserved u16, interval u32, then one entry every interval records:
+#   timestamp of the record i64, byte offset in the log of the block holding it u64, record number u64.
+# Entries are written after their block, so they never point past the data.
+
+# Record flags: the magnetometer or pressure values were read since the previous record,
+# rather than carried over from an earlier read
+FLAG_MAG = 0x0001
+FLAG_PRESSURE = 0x0002
+
+class LogError(Exception):
+    pass
+
+def crc(data):
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+def headerSize(metadata):
+    used = HEADER.size + len(metadata)
+    return (used + BLOCK_SIZE - 1) // BLOCK_SIZE * BLOCK_SIZE
+
+def readHeader(file):
+    # Returns (header size, metadata dict) and leaves the file at the first block
+    fields = HEADER.unpack(file.read(HEADER.size))
+    magic, version, size, blockSize, recordSize, recordsPerBlock, length = fields
+    if magic != MAGIC:
+        raise LogError("Not a sample log")
+    if version != VERSION or blockSize != BLOCK_SIZE or recordSize != RECORD.size:
+        raise LogError("Unsupported sample log version %d" % version)
+    metadata = json.loads(file.read(length).decode("utf-8"))
+    file.seek(size)
+    return size, metadata
+
+def indexPath(path):
+    return path + INDEX_SUFFIX
+
+def readIndexHeader(file):
+    # Returns the interval and leaves the file at the first entry
+    magic, version, reserved, interval = INDEX_HEADER.unpack(file.read(INDEX_HEADER.size))
+    if magic != INDEX_MAGIC:
+        raise LogError("Not a sample log index")
+    if version != VERSION:
+        raise LogError("Unsupported sample log index version %d" % version)
+    return interval
+
+def write(file, data, offset):
+    # Writes all of data to an unbuffered file that ends at offset. Such a write may take only part of it,
+    # e.g. as the card fills up, so this carries on with the rest. When a write fails the file is cut back to
+    # offset, so a part that did get written can't shift everything after it. A pipe can't be cut back,
+    # the stream is broken then anyway.
+    view = memoryview(data)
+    try:
+        while view:
+            view = view[file.write(view):]
+    except (IOError, OSError):
+        try:
+            file.truncate(offset)
+            file.seek(offset)
+        except (IOError, OSError):
+            pass
+        raise
+
+class LogWriter():
+    # Packs records straight into a preallocated block buffer and writes each block once it is full,
+    # about 4.7 writes a second at 476 Hz. Unbuffered, so nothing sits in a second copy.
+    # Every indexInterval records also goes into the index side file, None leaves it out.
+
+    def __init__(self, path, metadata, indexInterval=INDEX_INTERVAL):
+        self.metadata = metadata
+        self.block = bytearray(BLOCK_SIZE)
+        self.view = memoryview(self.block)
+        self.count = 0
+        self.sequence = 0
+        self.records = 0
+        self.blocks = 0
+        # Blocks written, across every file the writer has had
+        self.stored = 0
+
+        self.indexInterval = indexInterval
+        # (timestamp, record number) of the records in the current block that go into the index
+        self.marks = []
+        self.open(path, metadata)
+
+    def open(self, path, metadata):
+        # Starts a file with its header and index. Record numbers and sequences carry on from any file before.
+        self.path = path
+        self.file = self.openFile(path)
+        # Blocks in the file, fewer than blocks when some were dropped before reaching it
+        self.written = 0
+
+        encoded = json.dumps(metadata, sort_keys=True).encode("utf-8")
+        header = bytearray(headerSize(encoded))
+        HEADER.pack_into(header, 0, MAGIC, VERSION, len(header), BLOCK_SIZE, RECORD.size, RECORDS_PER_BLOCK,
+                         len(encoded))
+        header[HEADER.size:HEADER.size + len(encoded)] = encoded
+        write(self.file, header, 0)
+        self.headerSize = len(header)
+
+        # The new index is ready before it replaces the old one, append() may look at it from another thread
+        index = None
+        if self.indexInterval:
+            index = open(indexPath(path), "wb", buffering=0)
+            write(index, INDEX_HEADER.pack(INDEX_MAGIC, VERSION, 0, self.indexInterval), 0)
+        self.indexSize = INDEX_HEADER.size
+        self.index = index
+
+    def openFile(self, path):
+        return open(path, "wb", buffering=0)
+
+    def append(self, timestamp, values, adcT, adcP, flags):
+        if self.index is not None and self.records % self.indexInterval == 0:
+            self.marks.append((timestamp, self.records))
+        RECORD.pack_into(self.block, BLOCK_HEADER.size + self.count * RECORD.size,
+                         timestamp, *(tuple(values) + (adcT, adcP, flags, self.sequence)))
+        self.count += 1
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        self.records += 1
+        if self.count == RECORDS_PER_BLOCK:
+            self.writeBlock()
+
+    def writeBlock(self):
+        end = BLOCK_HEADER.size + self.count * RECORD.size
+        # Clears what a previous, fuller block left behind
+        self.block[end:] = bytes(BLOCK_SIZE - end)
+        first = (self.sequence - self.count) & 0xFFFFFFFF
+        BLOCK_HEADER.pack_into(self.block, 0, BLOCK_MAGIC, self.count, 0, crc(self.view[BLOCK_HEADER.size:end]), first)
+        self.commit(self.block, self.marks)
+        self.blocks += 1
+        self.count = 0
+        self.marks = []
+
+    def commit(self, block, marks):
+        # Hands over a finished block, LogWriter writes it right away
+        self.output([(block, marks)])
+
+    def output(self, blocks):
+        # Writes finished blocks, as (data, marks), in one go. Index entries get the offset the block actually
+        # lands at. A failed write leaves the file as it was, so written and the offsets still match it.
+        entries = []
+        for number, (data, marks) in enumerate(blocks):
+            offset = self.headerSize + (self.written + number) * BLOCK_SIZE
+            entries.extend(INDEX_ENTRY.pack(timestamp, offset, record) for timestamp, record in marks)
+        write(self.file, blocks[0][0] if len(blocks) == 1 else b"".join(data for data, marks in blocks),
+              self.headerSize + self.written * BLOCK_SIZE)
+        self.written += len(blocks)
+        self.stored += len(blocks)
+        if entries:
+            entries = b"".join(entries)
+            write(self.index, entries, self.indexSize)
+            self.indexSize += len(entries)
+
+    def flush(self):
+        # Writes the records so far as a partly filled block, which ends the file: readers count on every
+        # block but the last being full.
+        if self.count:
+            self.writeBlock()
+
+    def closeFiles(self):
+        self.file.close()
+        if self.index is not None:
+            self.index.close()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.closeFiles()
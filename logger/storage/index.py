@@ -0,0 +1,130 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+from storage import binlog
+
+# binlog.INDEX_ENTRY as a NumPy structured type
+ENTRY = np.dtype([("time", "<i8"), ("offset", "<u8"), ("record", "<u8")])
+
+class Index():
+    # The sparse timestamp index of a log: one entry every interval records. A time range query binary
+    # searches the entries and then only reads the blocks between the two it lands on, whatever the length
+    # of the capture.
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            self.interval = binlog.readIndexHeader(file)
+
+        # An entry cut short by a crash is ignored
+        count = (os.path.getsize(path) - binlog.INDEX_HEADER.size) // binlog.INDEX_ENTRY.size
+        if count > 0:
+            self.entries = np.memmap(path, ENTRY, mode="r", offset=binlog.INDEX_HEADER.size, shape=(count,))
+        else:
+            self.entries = np.zeros(0, ENTRY)
+        self.times = np.asarray(self.entries["time"])
+
+    def __len__(self):
+        return len(self.entries)
+
+    def offsets(self, start, stop):
+        # Byte offsets of the first block that may hold records with start <= time < stop, and of the block
+        # after the last one, None when that is the end of the log
+        first = int(np.searchsorted(self.times, start)) - 1
+        last = int(np.searchsorted(self.times, stop))
+        low = int(self.entries["offset"][first]) if first >= 0 else None
+        high = int(self.entries["offset"][last]) + binlog.BLOCK_SIZE if last < len(self) else None
+        return low, high
+
+def load(logPath):
+    # The index of a log, or None if it has none
+    path = binlog.indexPath(logPath)
+    if not os.path.exists(path):
+        return None
+    return Index(path)
+
+def rebuild(logPath, interval=binlog.INDEX_INTERVAL):
+    # Writes the index of a log that was recorded without one, or whose index was lost
+    from storage import reader
+    log = reader.LogReader(logPath)
+    mask = log.mask()
+    records = log.records[mask]
+    blocks = np.nonzero(mask)[0]
+
+    entries = np.zeros((len(records) + interval - 1) // interval, ENTRY)
+    entries["time"] = records["time"][::interval]
+    entries["offset"] = log.headerSize + blocks[::interval].astype(np.uint64) * binlog.BLOCK_SIZE
+    entries["record"] = np.arange(0, len(records), interval)
+
+    with open(binlog.indexPath(logPath), "wb") as file:
+        file.write(binlog.INDEX_HEADER.pack(binlog.INDEX_MAGIC, binlog.VERSION, 0, interval))
+        file.write(entries.tobytes())
+    log.close()
+    return len(entries)
+
+def writeCSV(records, origin, output):
+    output.write("time,accX,accY,accZ,gyrX,gyrY,gyrZ,magX,magY,magZ,adcT,adcP,flags,sequence\n")
+    for record in records:
+        output.write("%.6f,%s,%d,%d,%d,%d\n" % (
+            (record["time"] - origin) / 1e9,
+            ",".join(str(value) for value in np.concatenate([record["acc"], record["gyr"], record["mag"]])),
+            record["adcT"], record["adcP"], record["flags"], record["sequence"]))
+
+def writeLog(records, metadata, path):
+    log = binlog.LogWriter(path, metadata)
+    for record in records:
+        values = np.concatenate([record["acc"], record["gyr"], record["mag"]]).tolist()
+        log.append(int(record["time"]), values, int(record["adcT"]), int(record["adcP"]), int(record["flags"]))
+    log.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract a time window from a binary sample log")
+    parser.add_argument("log", help="binary log file")
+    parser.add_argument("--start", type=float, default=None,
+                        help="start of the window, seconds after the first record")
+    parser.add_argument("--stop", type=float, default=None,
+                        help="end of the window, seconds after the first record")
+    parser.add_argument("--around", type=float, default=None,
+                        help="centre of the window, seconds after the first record, instead of --start/--stop")
+    parser.add_argument("--span", type=float, default=30,
+                        help="length of the window around --around in seconds")
+    parser.add_argument("--output", default=None,
+                        help="write the window as a binary log, by default it is printed as CSV")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="write the index of the log first")
+    args = parser.parse_args()
+
+    from storage import reader
+
+    if args.rebuild:
+        sys.stderr.write("Indexed %d entries\n" % rebuild(args.log))
+
+    began = time.time()
+    log = reader.LogReader(args.log)
+    if log.index is None:
+        sys.stderr.write("%s has no index, the query reads the whole log. --rebuild writes one\n" % args.log)
+    if len(log) == 0:
+        return
+
+    origin = int(log.records["time"][0, 0])
+    if args.around is not None:
+        start, stop = args.around - args.span / 2, args.around + args.span / 2
+    else:
+        start = args.start if args.start is not None else 0
+        stop = args.stop if args.stop is not None else float("inf")
+    end = origin + int(stop * 1e9) if stop != float("inf") else np.iinfo(np.int64).max
+    records = log.between(origin + int(start * 1e9), end)
+    sys.stderr.write("%d records in %.1f ms\n" % (len(records), (time.time() - began) * 1000))
+
+    if args.output is not None:
+        writeLog(records, log.metadata, args.output)
+    else:
+        writeCSV(records, origin, sys.stdout)
+    log.close()
+
+if __name__ == "__main__":
+    main()
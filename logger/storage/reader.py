@@ -0,0 +1,137 @@
+import os
+
+import numpy as np
+
+from storage import binlog
+from storage import index
+
+# binlog.RECORD and binlog.BLOCK_HEADER as NumPy structured types, so a log maps straight onto arrays
+RECORD = np.dtype([("time", "<i8"), ("acc", "<i2", (3,)), ("gyr", "<i2", (3,)), ("mag", "<i2", (3,)),
+                   ("adcT", "<u4"), ("adcP", "<u4"), ("flags", "<u2"), ("sequence", "<u4")])
+BLOCK = np.dtype([("magic", "S4"), ("count", "<u2"), ("reserved", "<u2"), ("crc", "<u4"), ("first", "<u4"),
+                  ("records", RECORD, (binlog.RECORDS_PER_BLOCK,))])
+
+class LogReader():
+    # Maps a binary sample log into memory as NumPy arrays, nothing is read until it is touched.
+    #
+    # records is a (blocks, RECORDS_PER_BLOCK) view straight onto the file, and column() gives one field of it,
+    # for running filters over a whole capture without copying. Only the first counts[i] records of block i
+    # are valid, see mask(). Slicing by record index or by time copies just the selected records, or returns
+    # a view when they all sit in one block.
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as file:
+            self.headerSize, self.metadata = binlog.readHeader(file)
+
+        # A block cut short by a crash is ignored
+        count = (os.path.getsize(path) - self.headerSize) // binlog.BLOCK_SIZE
+        if count > 0:
+            self.blocks = np.memmap(path, BLOCK, mode="r", offset=self.headerSize, shape=(count,))
+        else:
+            self.blocks = np.zeros(0, BLOCK)
+        self.records = self.blocks["records"]
+        self._offsets = None
+        self.index = index.load(path)
+
+    def counts(self):
+        return self.blocks["count"]
+
+    def offsets(self):
+        # Index of the first record of every block, plus the total at the end. Only the last block of a file
+        # can be partly filled, so this reads just that block's header rather than one page per block.
+        if self._offsets is None:
+            count = len(self.blocks)
+            self._offsets = np.arange(count + 1, dtype=np.int64) * binlog.RECORDS_PER_BLOCK
+            if count > 0:
+                self._offsets[-1] = self._offsets[-2] + int(self.blocks["count"][-1])
+        return self._offsets
+
+    def __len__(self):
+        return int(self.offsets()[-1])
+
+    def mask(self):
+        # True for the valid slots of records
+        return np.arange(binlog.RECORDS_PER_BLOCK) < self.counts()[:, None]
+
+    def column(self, name):
+        return self.records[name]
+
+    def locate(self, index):
+        # (block, slot) of a record index
+        block = int(np.searchsorted(self.offsets(), index, side="right")) - 1
+        return block, index - int(self.offsets()[block])
+
+    def slice(self, start, stop):
+        start = max(0, min(start, len(self)))
+        stop = max(start, min(stop, len(self)))
+        if start == stop:
+            return np.zeros(0, RECORD)
+
+        firstBlock, firstSlot = self.locate(start)
+        lastBlock, lastSlot = self.locate(stop - 1)
+        if firstBlock == lastBlock:
+            return self.records[firstBlock, firstSlot:lastSlot + 1]
+
+        parts = [self.records[firstBlock, firstSlot:self.counts()[firstBlock]]]
+        for block in range(firstBlock + 1, lastBlock):
+            parts.append(self.records[block, :self.counts()[block]])
+        parts.append(self.records[lastBlock, :lastSlot + 1])
+        return np.concatenate(parts)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            # Reads the covered range in order, then steps through it, backwards for a negative step
+            indices = range(*key.indices(len(self)))
+            if not indices:
+                return np.zeros(0, RECORD)
+            low = min(indices[0], indices[-1])
+            records = self.slice(low, max(indices[0], indices[-1]) + 1)
+            return records if indices.step == 1 else records[indices[0] - low::indices.step]
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError("Record %d out of range" % key)
+        block, slot = self.locate(key)
+        return self.records[block, slot]
+
+    def indexOf(self, timestamp):
+        # Index of the first record at or after a clock.monotonic_ns() timestamp. Binary searches the first
+        # record of each block, then inside the one block, so only those pages are read.
+        if len(self) == 0:
+            return 0
+        firsts = self.records["time"][:, 0]
+        block = int(np.searchsorted(firsts, timestamp, side="right")) - 1
+        if block < 0:
+            return 0
+        times = self.records["time"][block, :self.counts()[block]]
+        return int(self.offsets()[block]) + int(np.searchsorted(times, timestamp))
+
+    def between(self, start, stop):
+        # Records with start <= time < stop, in clock.monotonic_ns(). With an index only the blocks it
+        # narrows the range down to are read, otherwise this touches every block once.
+        if self.index is None:
+            return self.slice(self.indexOf(start), self.indexOf(stop))
+
+        low, high = self.index.offsets(start, stop)
+        first = (low - self.headerSize) // binlog.BLOCK_SIZE if low is not None else 0
+        last = (high - self.headerSize) // binlog.BLOCK_SIZE if high is not None else len(self.blocks)
+        blocks = self.blocks[first:last]
+        records = blocks["records"][np.arange(binlog.RECORDS_PER_BLOCK) < blocks["count"][:, None]]
+        times = records["time"]
+        return records[(times >= start) & (times < stop)]
+
+    def verify(self):
+        # Blocks whose magic or CRC doesn't match, e.g. after a crash mid-write
+        bad = []
+        for block in range(len(self.blocks)):
+            count = self.counts()[block]
+            data = self.records[block, :count].tobytes()
+            if self.blocks["magic"][block] != binlog.BLOCK_MAGIC or binlog.crc(data) != self.blocks["crc"][block]:
+                bad.append(block)
+        return bad
+
+    def close(self):
+        # The file is unmapped once no view of it is left
+        self.blocks = None
+        self.records = None
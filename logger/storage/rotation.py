@@ -0,0 +1,162 @@
+import os
+import shutil
+import subprocess
+
+from sensors import clock
+from storage import binlog
+from storage import writer
+
+# Compression tools, run as separate processes so they use another core and never hold up logging:
+# (command that compresses a file in place, removing it, command that compresses stdin to stdout, suffix)
+CODECS = {
+    "zstd": (["zstd", "-q", "--rm"], ["zstd", "-q", "-c"], ".zst"),
+    "gzip": (["gzip", "-q"], ["gzip", "-q", "-c"], ".gz"),
+}
+
+def codec(name):
+    # The codec to use for name: gzip when zstd isn't installed, None for no compression
+    if name is None or name == "none":
+        return None
+    if shutil.which(CODECS[name][0][0]) is None:
+        return codec("gzip") if name != "gzip" else None
+    return name
+
+def nice(command):
+    # Compression is background work, the sampler comes first
+    return (["nice", "-n", "10"] if shutil.which("nice") else []) + command
+
+class Compressor():
+    # Compresses closed log segments one at a time in child processes. The children get their own session,
+    # so the Ctrl-C that stops the logger doesn't also kill a compression half way.
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.pending = []
+        self.process = None
+        self.compressed = 0
+        self.failed = 0
+
+    def add(self, path):
+        self.pending.append(path)
+        self.poll()
+
+    def poll(self):
+        # Reaps a finished child and starts the next one, never waits
+        if self.process is not None:
+            status = self.process.poll()
+            if status is None:
+                return
+            if status == 0:
+                self.compressed += 1
+            else:
+                self.failed += 1
+            self.process = None
+        if self.pending:
+            command = CODECS[self.codec][0] + [self.pending.pop(0)]
+            self.process = subprocess.Popen(nice(command), start_new_session=True)
+
+    def close(self):
+        while self.process is not None or self.pending:
+            if self.process is not None:
+                self.process.wait()
+            self.poll()
+
+class RotatingWriter(writer.BackgroundWriter):
+    # A BackgroundWriter that splits a recording into segments, PATH-0000.imulog, PATH-0001.imulog and so
+    # on, each a complete log with its own header and index. A segment is closed once it holds maxBytes or
+    # has been open for maxSeconds (0 turns either limit off) and then compressed by a Compressor.
+    #
+    # With streaming, the active segment is piped through the compressor as it is written instead, so an
+    # uncompressed copy never touches the card. The index offsets then count uncompressed bytes, as does
+    # maxBytes. Either way a segment is read again after decompressing it, e.g. with zstd -d.
+    #
+    # Rotation happens on the writer thread, once the next block no longer fits in the active segment. A group
+    # commit may be split across two segments, and closing never leaves an empty one behind.
+
+    def __init__(self, path, metadata, maxBytes=64 * 1024 * 1024, maxSeconds=3600, compression="zstd",
+                 streaming=False, **options):
+        self.base = path
+        self.segment = 0
+        self.maxBytes = maxBytes
+        self.maxSeconds = maxSeconds
+        self.codec = codec(compression)
+        self.streaming = streaming and self.codec is not None
+        self.stream = None
+        self.opened = clock.monotonic()
+        self.compressor = Compressor(self.codec) if self.codec is not None and not self.streaming else None
+        writer.BackgroundWriter.__init__(self, self.segmentPath(0), dict(metadata, segment=0), **options)
+
+    def segmentPath(self, segment):
+        root, extension = os.path.splitext(self.base)
+        return "%s-%04d%s" % (root, segment, extension or ".imulog")
+
+    def openFile(self, path):
+        self.opened = clock.monotonic()
+        if not self.streaming:
+            return writer.BackgroundWriter.openFile(self, path)
+        compressed, suffix = CODECS[self.codec][1], CODECS[self.codec][2]
+        with open(path + suffix, "wb") as output:
+            self.stream = subprocess.Popen(nice(compressed), stdin=subprocess.PIPE, stdout=output,
+                                           start_new_session=True)
+        return self.stream.stdin
+
+    def closeFiles(self):
+        writer.BackgroundWriter.closeFiles(self)
+        if self.stream is not None:
+            if self.stream.wait() != 0:
+                self.errors += 1
+            self.stream = None
+        elif self.compressor is not None:
+            self.compressor.add(self.path)
+
+    def sync(self):
+        # A pipe can't be synced, only the index and what the compressor writes once the segment is closed
+        if self.stream is None:
+            writer.BackgroundWriter.sync(self)
+        elif self.index is not None:
+            os.fsync(self.index.fileno())
+            self.syncs += 1
+            self.lastSync = clock.monotonic()
+
+    def full(self):
+        if self.maxBytes and self.headerSize + self.written * binlog.BLOCK_SIZE >= self.maxBytes:
+            return True
+        return bool(self.maxSeconds) and clock.monotonic() - self.opened >= self.maxSeconds
+
+    def room(self):
+        # Blocks that still fit in the active segment, None without a size limit
+        if not self.maxBytes:
+            return None
+        left = self.maxBytes - self.headerSize - self.written * binlog.BLOCK_SIZE
+        return max(1, (left + binlog.BLOCK_SIZE - 1) // binlog.BLOCK_SIZE)
+
+    def output(self, blocks):
+        while blocks:
+            if self.full():
+                self.rotate()
+            room = self.room()
+            writer.BackgroundWriter.output(self, blocks[:room])
+            blocks = blocks[room:] if room is not None else []
+        if self.compressor is not None:
+            self.compressor.poll()
+
+    def rotate(self):
+        if self.fsyncInterval is not None:
+            self.sync()
+        self.closeFiles()
+        self.segment += 1
+        self.open(self.segmentPath(self.segment), dict(self.metadata, segment=self.segment))
+
+    def close(self):
+        # Also waits for the last segments to be compressed
+        writer.BackgroundWriter.close(self)
+        if self.compressor is not None:
+            self.compressor.close()
+
+    def __str__(self):
+        text = writer.BackgroundWriter.__str__(self)
+        text += "Segments: %d\t Compression: %s%s" % (self.segment + 1, self.codec or "none",
+                                                     " (streaming)" if self.streaming else "")
+        if self.compressor is not None:
+            text += "\t Compressed: %d\t Failed: %d" % (self.compressor.compressed, self.compressor.failed)
+        return text + "\n"
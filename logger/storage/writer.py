@@ -0,0 +1,127 @@
+import collections
+import os
+import threading
+
+from sensors import clock
+from storage import binlog
+
+class BackgroundWriter(binlog.LogWriter):
+    # A LogWriter that only packs records on the caller's thread. Finished blocks go through a bounded queue
+    # to a writer thread, so an SD card write that stalls for hundreds of milliseconds holds up that thread
+    # and not the sensor loop.
+    #
+    # The writer thread takes every block waiting in the queue and writes them with one call (group commit),
+    # then calls fsync once fsyncInterval seconds have passed since the last one: 0 syncs after every write,
+    # None leaves it to the OS.
+    #
+    # When the queue is full, the overflow policy decides:
+    #   BLOCK        the caller waits for room, losing nothing but stalling the loop
+    #   DROP_OLDEST  the oldest queued block is dropped to make room
+    #   DROP_NEWEST  the new block is dropped
+    # Dropped blocks leave a gap in the record sequence numbers, which readers can see in the block headers.
+    BLOCK = "block"
+    DROP_OLDEST = "drop-oldest"
+    DROP_NEWEST = "drop-newest"
+    POLICIES = [BLOCK, DROP_OLDEST, DROP_NEWEST]
+
+    def __init__(self, path, metadata, capacity=64, policy=DROP_OLDEST, fsyncInterval=1.0,
+                 indexInterval=binlog.INDEX_INTERVAL):
+        binlog.LogWriter.__init__(self, path, metadata, indexInterval)
+        if policy not in BackgroundWriter.POLICIES:
+            raise ValueError("Unknown overflow policy %s" % policy)
+        self.capacity = capacity
+        self.policy = policy
+        self.fsyncInterval = fsyncInterval
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        # closing turns the drop policies off for the last blocks, stopped ends the thread once they are out
+        self.closing = False
+        self.stopped = False
+        self.lastSync = clock.monotonic()
+
+        self.queued = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.maxDepth = 0
+        self.errors = 0
+        self.commits = 0
+        self.syncs = 0
+        self.maxCommitTime = 0.0
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def commit(self, block, marks):
+        # The block buffer is reused for the next block, so the queue gets a copy
+        with self.condition:
+            if len(self.queue) >= self.capacity:
+                if self.policy == BackgroundWriter.DROP_NEWEST and not self.closing:
+                    self.dropped += 1
+                    return
+                elif self.policy == BackgroundWriter.DROP_OLDEST and not self.closing:
+                    self.queue.popleft()
+                    self.dropped += 1
+                else:
+                    self.blocked += 1
+                    while len(self.queue) >= self.capacity:
+                        self.condition.wait()
+            self.queue.append((bytes(block), marks))
+            self.queued += 1
+            self.maxDepth = max(self.maxDepth, len(self.queue))
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+                if not self.queue:
+                    break
+                blocks = list(self.queue)
+                self.queue.clear()
+                self.condition.notify_all()
+
+            began = clock.monotonic()
+            stored = self.stored
+            try:
+                self.output(blocks)
+                self.commits += 1
+                if self.fsyncInterval is not None and began - self.lastSync >= self.fsyncInterval:
+                    self.sync()
+            except (IOError, OSError):
+                # e.g. a full card: blocks that didn't reach the file are lost, the thread carries on
+                self.errors += 1
+                self.dropped += len(blocks) - (self.stored - stored)
+            self.maxCommitTime = max(self.maxCommitTime, clock.monotonic() - began)
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        if self.index is not None:
+            os.fsync(self.index.fileno())
+        self.syncs += 1
+        self.lastSync = clock.monotonic()
+
+    def close(self):
+        # Waits for everything queued so far to be written, whatever the policy
+        with self.condition:
+            if self.closing:
+                return
+            self.closing = True
+        self.flush()
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+        if self.fsyncInterval is not None:
+            try:
+                self.sync()
+            except (IOError, OSError):
+                self.errors += 1
+        self.closeFiles()
+
+    def __str__(self):
+        return "Log queue: %d blocks\t Written: %d\t Dropped: %d\t Blocked: %d\t Max depth: %d/%d\t " \
+               "Commits: %d\t Syncs: %d\t Max commit: %.1f ms\t Errors: %d\n" % (
+                   self.queued, self.stored, self.dropped, self.blocked, self.maxDepth, self.capacity,
+                   self.commits, self.syncs, self.maxCommitTime * 1000, self.errors)
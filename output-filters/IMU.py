@@ -1,5 +1,15 @@
-import smbus
-bus = smbus.SMBus(1)
+import os
+import sys
+import struct
+
+#The bus layer is shared with the logger, see logger/sensors/bus.py.
+#Set BERRYIMU_BUS to run without a Pi, e.g. BERRYIMU_BUS=sim or BERRYIMU_BUS=replay:capture.txt
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'logger'))
+from sensors import bus as buses
+from sensors import calibration
+from sensors import clock
+busSpec = os.environ.get('BERRYIMU_BUS', 'smbus:1')
+bus = buses.connect(busSpec)
 from LSM9DS0 import *
 from LSM9DS1 import *
 import time
@@ -9,12 +19,100 @@ import time
 LSM9DS0 = 1
 
 
+#Output registers hold X, Y and Z as little-endian signed 16-bit values
+XYZ = struct.Struct('<hhh')
+
+#Setting the MSB of the register address enables auto-increment on a block read.
+#The LSM9DS0 and the LSM9DS1 magnetometer need it, the LSM9DS1 accel/gyro increment by default.
+AUTO_INCREMENT = 0x80
+
+
+
+class IMUReader(object):
+    #Addresses and output registers for one chip, resolved once by detectIMU()
+
+    def __init__(self, accAddress, accRegister, gyrAddress, gyrRegister, magAddress, magRegister,
+                 accStatus, gyrStatus, magStatus):
+        self.accAddress = accAddress
+        self.accRegister = accRegister
+        self.gyrAddress = gyrAddress
+        self.gyrRegister = gyrRegister
+        self.magAddress = magAddress
+        self.magRegister = magRegister
+        #Each status is (address, register, data ready mask, overrun mask)
+        self.statuses = [accStatus, gyrStatus, magStatus]
+        #clock.monotonic_ns() when the last read of each sensor completed
+        self.accTime = None
+        self.gyrTime = None
+        self.magTime = None
+
+    def readStatus(self):
+        #Returns [accReady, gyrReady, magReady, overrun], reading a shared status register only once
+        values = {}
+        ready = []
+        overrun = False
+        for address, register, readyMask, overrunMask in self.statuses:
+            if (address, register) not in values:
+                values[(address, register)] = bus.read_byte_data(address, register)
+            status = values[(address, register)]
+            ready.append(bool(status & readyMask))
+            overrun = overrun or bool(status & overrunMask)
+        return ready + [overrun]
+
+    def readACC(self):
+        block = bus.read_i2c_block_data(self.accAddress, self.accRegister, 6)
+        self.accTime = clock.monotonic_ns()
+        return XYZ.unpack(bytearray(block))
+
+    def readGYR(self):
+        block = bus.read_i2c_block_data(self.gyrAddress, self.gyrRegister, 6)
+        self.gyrTime = clock.monotonic_ns()
+        return XYZ.unpack(bytearray(block))
+
+    def readMAG(self):
+        block = bus.read_i2c_block_data(self.magAddress, self.magRegister, 6)
+        self.magTime = clock.monotonic_ns()
+        return XYZ.unpack(bytearray(block))
+
+    def readMAGStatus(self):
+        #Returns [magReady, overrun] from the magnetometer status register alone
+        address, register, readyMask, overrunMask = self.statuses[2]
+        status = bus.read_byte_data(address, register)
+        return [bool(status & readyMask), bool(status & overrunMask)]
+
+
+READERS = {
+    1: IMUReader(LSM9DS0_ACC_ADDRESS, LSM9DS0_OUT_X_L_A | AUTO_INCREMENT,
+                 LSM9DS0_GYR_ADDRESS, LSM9DS0_OUT_X_L_G | AUTO_INCREMENT,
+                 LSM9DS0_MAG_ADDRESS, LSM9DS0_OUT_X_L_M | AUTO_INCREMENT,
+                 (LSM9DS0_ACC_ADDRESS, LSM9DS0_STATUS_REG_A, 0b00001000, 0b10000000),
+                 (LSM9DS0_GYR_ADDRESS, LSM9DS0_STATUS_REG_G, 0b00001000, 0b10000000),
+                 (LSM9DS0_MAG_ADDRESS, LSM9DS0_STATUS_REG_M, 0b00001000, 0b10000000)),
+    0: IMUReader(LSM9DS1_ACC_ADDRESS, LSM9DS1_OUT_X_L_XL,
+                 LSM9DS1_GYR_ADDRESS, LSM9DS1_OUT_X_L_G,
+                 LSM9DS1_MAG_ADDRESS, LSM9DS1_OUT_X_L_M | AUTO_INCREMENT,
+                 (LSM9DS1_ACC_ADDRESS, LSM9DS1_STATUS_REG_1, 0b00000001, 0b00000000),    #No overrun flag for accel/gyro
+                 (LSM9DS1_GYR_ADDRESS, LSM9DS1_STATUS_REG_1, 0b00000010, 0b00000000),
+                 (LSM9DS1_MAG_ADDRESS, LSM9DS1_STATUS_REG_M, 0b00001000, 0b10000000)),
+}
+
+reader = READERS[LSM9DS0]
+
+
+#Data ready sampling state
+POLL_INTERVAL = 0.0005
+latest = None
+skipped = 0
+overruns = 0
+
+
 
 def detectIMU():
     #Detect which version of BerryIMU is connected.   
     #BerryIMUv1 uses the LSM9DS0
     #BerryIMUv2 uses the LSM9DS1
     global LSM9DS0
+    global reader
     
     
     try:
@@ -45,6 +143,8 @@ def detectIMU():
             print "Found LSM9DS1"
             LSM9DS0 = 0
 
+    reader = READERS[LSM9DS0]
+
     time.sleep(1)
 
 
@@ -52,231 +152,156 @@ def detectIMU():
     
 
 
-def writeAG(register,value):
-        bus.write_byte_data(ACC_ADDRESS , register, value)
-        return -1
 
 def writeACC(register,value):
-        bus.write_byte_data(ACC_ADDRESS , register, value)
-        return -1
+    bus.write_byte_data(reader.accAddress, register, value)
+    return -1
+    
 
 def writeMAG(register,value):
-        bus.write_byte_data(MAG_ADDRESS, register, value)
-        return -1
+    bus.write_byte_data(reader.magAddress, register, value)
+    return -1
 
 def writeGRY(register,value):
-        bus.write_byte_data(GYR_ADDRESS, register, value)
-        return -1
+    bus.write_byte_data(reader.gyrAddress, register, value)
+    return -1
 
 
+#Values the control registers of each address are known to hold, so initIMU only writes what changed
+shadow = {}
 
-def readACCx():
-        acc_l = bus.read_byte_data(ACC_ADDRESS, OUT_X_L_XL)
-        acc_h = bus.read_byte_data(ACC_ADDRESS, OUT_X_H_XL)
-	acc_combined = (acc_l | acc_h <<8)
+def configure(address, registers, autoIncrement):
+    #Writes a {register: value} dict to one device. Registers not cached yet are read one block per run of
+    #consecutive registers, never reading across the gaps, where status and output registers are cleared
+    #or popped from the FIFO by a read. Changed registers next to each other are written together in one block.
+    known = shadow.setdefault(address, {})
+    missing = sorted(r for r in registers if r not in known)
+    while missing:
+        run = [missing.pop(0)]
+        while missing and missing[0] == run[-1] + 1:
+            run.append(missing.pop(0))
+        values = bus.read_i2c_block_data(address, run[0] | autoIncrement, len(run))
+        known.update(zip(run, values))
 
-	return acc_combined  if acc_combined < 32768 else acc_combined - 65536
+    changed = sorted(r for r in registers if known[r] != registers[r])
+    while changed:
+        run = [changed.pop(0)]
+        while changed and changed[0] == run[-1] + 1:
+            run.append(changed.pop(0))
+        if len(run) == 1:
+            bus.write_byte_data(address, run[0], registers[run[0]])
+        else:
+            bus.write_i2c_block_data(address, run[0] | autoIncrement, [registers[r] for r in run])
+        for r in run:
+            known[r] = registers[r]
 
 
-def readACCy():
-        acc_l = bus.read_byte_data(ACC_ADDRESS, OUT_Y_L_XL)
-        acc_h = bus.read_byte_data(ACC_ADDRESS, OUT_Y_H_XL)
-	acc_combined = (acc_l | acc_h <<8)
 
-	return acc_combined  if acc_combined < 32768 else acc_combined - 65536
+def readACC():
+    return reader.readACC()
 
 
-def readACCz():
-        acc_l = bus.read_byte_data(ACC_ADDRESS, OUT_Z_L_XL)
-        acc_h = bus.read_byte_data(ACC_ADDRESS, OUT_Z_H_XL)
-	acc_combined = (acc_l | acc_h <<8)
+def readGYR():
+    return reader.readGYR()
 
-	return acc_combined  if acc_combined < 32768 else acc_combined - 65536
 
+def readMAG():
+    return reader.readMAG()
 
-def readMAGx():
-		mag_l = bus.read_byte_data(MAG_ADDRESS, OUT_X_L_M)
-		mag_h = bus.read_byte_data(MAG_ADDRESS, OUT_X_H_M)
-		mag_combined = (mag_l | mag_h <<8)
-		return mag_combined  if mag_combined < 32768 else mag_combined - 65536
 
+def gyrTime():
+    #clock.monotonic_ns() of the last gyroscope read, for integrating the gyro rate
+    return reader.gyrTime
 
-def readMAGy():
-        mag_l = bus.read_byte_data(MAG_ADDRESS, OUT_Y_L_M)
-        mag_h = bus.read_byte_data(MAG_ADDRESS, OUT_Y_H_M)
-        mag_combined = (mag_l | mag_h <<8)
 
-        return mag_combined  if mag_combined < 32768 else mag_combined - 65536
 
+def readNewMAG():
+    #Wait for a new magnetometer sample, so every sample is read exactly once at the full ODR
+    while not reader.readMAGStatus()[0]:
+        time.sleep(POLL_INTERVAL)
+    return reader.readMAG()
 
-def readMAGz():
-        mag_l = bus.read_byte_data(MAG_ADDRESS, OUT_Z_L_M)
-        mag_h = bus.read_byte_data(MAG_ADDRESS, OUT_Z_H_M)
-        mag_combined = (mag_l | mag_h <<8)
 
-        return mag_combined  if mag_combined < 32768 else mag_combined - 65536
 
+def calibrationKey():
+    #Same key the logger uses, so both share one calibration file
+    return calibration.key(busSpec, reader.magAddress)
 
-def readGYRx():
-        gyr_l = bus.read_byte_data(GYR_ADDRESS, OUT_X_L_G)
-        gyr_h = bus.read_byte_data(GYR_ADDRESS, OUT_X_H_G)
-        gyr_combined = (gyr_l | gyr_h <<8)
 
-        return gyr_combined  if gyr_combined < 32768 else gyr_combined - 65536
-  
+def loadCalibration(path=calibration.DEFAULT_PATH):
+    #Returns the compass calibration saved by calibrateBerryIMU.py, or None if there is none
+    return calibration.Store(path).load(calibrationKey())
 
-def readGYRy():
-        gyr_l = bus.read_byte_data(GYR_ADDRESS, OUT_Y_L_G)
-        gyr_h = bus.read_byte_data(GYR_ADDRESS, OUT_Y_H_G)
-        gyr_combined = (gyr_l | gyr_h <<8)
-
-        return gyr_combined  if gyr_combined < 32768 else gyr_combined - 65536
-
-def readGYRz():
-        gyr_l = bus.read_byte_data(GYR_ADDRESS, OUT_Z_L_G)
-        gyr_h = bus.read_byte_data(GYR_ADDRESS, OUT_Z_H_G)
-        gyr_combined = (gyr_l | gyr_h <<8)
 
-        return gyr_combined  if gyr_combined < 32768 else gyr_combined - 65536
+def saveCalibration(profile, path=calibration.DEFAULT_PATH):
+    calibration.Store(path).save(calibrationKey(), profile)
 
 
 
+def readNew():
+    #Wait for a new gyroscope sample, then only read the sensors flagged as having new data.
+    #Sensors without new data keep their previous values. Polls that find no new gyro data
+    #are counted in skipped, and samples the chip overwrote before we read them in overruns.
+    global latest, skipped, overruns
 
+    if latest is None:
+        latest = [reader.readACC(), reader.readGYR(), reader.readMAG()]
+        return tuple(latest)
 
+    while True:
+        accReady, gyrReady, magReady, overrun = reader.readStatus()
+        if overrun:
+            overruns += 1
+        if gyrReady:
+            break
+        skipped += 1
+        time.sleep(POLL_INTERVAL)
 
+    latest[1] = reader.readGYR()
+    if accReady:
+        latest[0] = reader.readACC()
+    if magReady:
+        latest[2] = reader.readMAG()
+    return tuple(latest)
 
 
 
-def writeACC(register,value):
-    if(LSM9DS0):
-        bus.write_byte_data(LSM9DS0_ACC_ADDRESS , register, value)
-    else:
-        bus.write_byte_data(LSM9DS1_ACC_ADDRESS , register, value)
-    return -1
-    
-
-def writeMAG(register,value):
-    if(LSM9DS0):
-        bus.write_byte_data(LSM9DS0_MAG_ADDRESS, register, value)
-    else:
-        bus.write_byte_data(LSM9DS1_MAG_ADDRESS , register, value)        
-        return -1
-
-def writeGRY(register,value):
-    if(LSM9DS0):
-        bus.write_byte_data(LSM9DS0_GYR_ADDRESS, register, value)
-    else:
-        bus.write_byte_data(LSM9DS1_GYR_ADDRESS , register, value)        
-        return -1
-
-
-
+#Single axis reads, kept for scripts that only need one value.
+#Reading all three axes with readACC(), readGYR() or readMAG() is cheaper.
 def readACCx():
-    if (LSM9DS0):
-        acc_l = bus.read_byte_data(LSM9DS0_ACC_ADDRESS, LSM9DS0_OUT_X_L_A)
-        acc_h = bus.read_byte_data(LSM9DS0_ACC_ADDRESS, LSM9DS0_OUT_X_H_A)
-    else:
-        acc_l = bus.read_byte_data(LSM9DS1_ACC_ADDRESS, LSM9DS1_OUT_X_L_XL)
-        acc_h = bus.read_byte_data(LSM9DS1_ACC_ADDRESS, LSM9DS1_OUT_X_H_XL)
-
-    acc_combined = (acc_l | acc_h <<8)
-    return acc_combined  if acc_combined < 32768 else acc_combined - 65536
+    return reader.readACC()[0]
 
 
 def readACCy():
-    if (LSM9DS0):
-        acc_l = bus.read_byte_data(LSM9DS0_ACC_ADDRESS, LSM9DS0_OUT_Y_L_A)
-        acc_h = bus.read_byte_data(LSM9DS0_ACC_ADDRESS, LSM9DS0_OUT_Y_H_A)
-    else:
-        acc_l = bus.read_byte_data(LSM9DS1_ACC_ADDRESS, LSM9DS1_OUT_Y_L_XL)
-        acc_h = bus.read_byte_data(LSM9DS1_ACC_ADDRESS, LSM9DS1_OUT_Y_H_XL)       
-    
-    acc_combined = (acc_l | acc_h <<8)
-    return acc_combined  if acc_combined < 32768 else acc_combined - 65536
+    return reader.readACC()[1]
 
 
 def readACCz():
-    if (LSM9DS0):
-        acc_l = bus.read_byte_data(LSM9DS0_ACC_ADDRESS, LSM9DS0_OUT_Z_L_A)
-        acc_h = bus.read_byte_data(LSM9DS0_ACC_ADDRESS, LSM9DS0_OUT_Z_H_A)
-    else:
-        acc_l = bus.read_byte_data(LSM9DS1_ACC_ADDRESS, LSM9DS1_OUT_Z_L_XL)
-        acc_h = bus.read_byte_data(LSM9DS1_ACC_ADDRESS, LSM9DS1_OUT_Z_H_XL)
-	
-    acc_combined = (acc_l | acc_h <<8)
-    return acc_combined  if acc_combined < 32768 else acc_combined - 65536
+    return reader.readACC()[2]
 
 
 def readMAGx():
-    if (LSM9DS0):
-        mag_l = bus.read_byte_data(LSM9DS0_MAG_ADDRESS, LSM9DS0_OUT_X_L_M)
-        mag_h = bus.read_byte_data(LSM9DS0_MAG_ADDRESS, LSM9DS0_OUT_X_H_M)
-    else:
-        mag_l = bus.read_byte_data(LSM9DS1_MAG_ADDRESS, LSM9DS1_OUT_X_L_M)
-        mag_h = bus.read_byte_data(LSM9DS1_MAG_ADDRESS, LSM9DS1_OUT_X_H_M)
-
-    mag_combined = (mag_l | mag_h <<8)
-    return mag_combined  if mag_combined < 32768 else mag_combined - 65536
+    return reader.readMAG()[0]
 
 
 def readMAGy():
-    if (LSM9DS0):
-        mag_l = bus.read_byte_data(LSM9DS0_MAG_ADDRESS, LSM9DS0_OUT_Y_L_M)
-        mag_h = bus.read_byte_data(LSM9DS0_MAG_ADDRESS, LSM9DS0_OUT_Y_H_M)
-    else:
-        mag_l = bus.read_byte_data(LSM9DS1_MAG_ADDRESS, LSM9DS1_OUT_Y_L_M)
-        mag_h = bus.read_byte_data(LSM9DS1_MAG_ADDRESS, LSM9DS1_OUT_Y_H_M)
-
-    mag_combined = (mag_l | mag_h <<8)
-    return mag_combined  if mag_combined < 32768 else mag_combined - 65536
+    return reader.readMAG()[1]
 
 
 def readMAGz():
-    if (LSM9DS0):
-        mag_l = bus.read_byte_data(LSM9DS0_MAG_ADDRESS, LSM9DS0_OUT_Z_L_M)
-        mag_h = bus.read_byte_data(LSM9DS0_MAG_ADDRESS, LSM9DS0_OUT_Z_H_M)
-    else:
-        mag_l = bus.read_byte_data(LSM9DS1_MAG_ADDRESS, LSM9DS1_OUT_Z_L_M)
-        mag_h = bus.read_byte_data(LSM9DS1_MAG_ADDRESS, LSM9DS1_OUT_Z_H_M)           
-
-    mag_combined = (mag_l | mag_h <<8)
-    return mag_combined  if mag_combined < 32768 else mag_combined - 65536
-
+    return reader.readMAG()[2]
 
 
 def readGYRx():
-    if (LSM9DS0):
-        gyr_l = bus.read_byte_data(LSM9DS0_GYR_ADDRESS, LSM9DS0_OUT_X_L_G)
-        gyr_h = bus.read_byte_data(LSM9DS0_GYR_ADDRESS, LSM9DS0_OUT_X_H_G)
-    else:
-        gyr_l = bus.read_byte_data(LSM9DS1_GYR_ADDRESS, LSM9DS1_OUT_X_L_G)
-        gyr_h = bus.read_byte_data(LSM9DS1_GYR_ADDRESS, LSM9DS1_OUT_X_H_G)
-    
-    gyr_combined = (gyr_l | gyr_h <<8)
-    return gyr_combined  if gyr_combined < 32768 else gyr_combined - 65536
-  
+    return reader.readGYR()[0]
+
 
 def readGYRy():
-    if (LSM9DS0):
-        gyr_l = bus.read_byte_data(LSM9DS0_GYR_ADDRESS, LSM9DS0_OUT_Y_L_G)
-        gyr_h = bus.read_byte_data(LSM9DS0_GYR_ADDRESS, LSM9DS0_OUT_Y_H_G)
-    else:
-        gyr_l = bus.read_byte_data(LSM9DS1_GYR_ADDRESS, LSM9DS1_OUT_Y_L_G)
-        gyr_h = bus.read_byte_data(LSM9DS1_GYR_ADDRESS, LSM9DS1_OUT_Y_H_G)
+    return reader.readGYR()[1]
 
-    gyr_combined = (gyr_l | gyr_h <<8)
-    return gyr_combined  if gyr_combined < 32768 else gyr_combined - 65536
 
 def readGYRz():
-    if (LSM9DS0):
-        gyr_l = bus.read_byte_data(LSM9DS0_GYR_ADDRESS, LSM9DS0_OUT_Z_L_G)
-        gyr_h = bus.read_byte_data(LSM9DS0_GYR_ADDRESS, LSM9DS0_OUT_Z_H_G)
-    else:
-        gyr_l = bus.read_byte_data(LSM9DS1_GYR_ADDRESS, LSM9DS1_OUT_Z_L_G)
-        gyr_h = bus.read_byte_data(LSM9DS1_GYR_ADDRESS, LSM9DS1_OUT_Z_H_G)
-
-    gyr_combined = (gyr_l | gyr_h <<8)
-    return gyr_combined  if gyr_combined < 32768 else gyr_combined - 65536
+    return reader.readGYR()[2]
 
 
 
@@ -285,34 +310,38 @@ def initIMU():
 
     if (LSM9DS0):   #For BerryIMUv1
 
-        #initialise the accelerometer
-        writeACC(LSM9DS0_CTRL_REG1_XM, 0b01100111)  #z,y,x axis enabled, continuos update,  100Hz data rate
-        writeACC(LSM9DS0_CTRL_REG2_XM, 0b00100000)  #+/- 16G full scale
-
-        #initialise the magnetometer
-        writeMAG(LSM9DS0_CTRL_REG5_XM, 0b11110000)  #Temp enable, M data rate = 50Hz
-        writeMAG(LSM9DS0_CTRL_REG6_XM, 0b01100000)  #+/-12gauss
-        writeMAG(LSM9DS0_CTRL_REG7_XM, 0b00000000)  #Continuous-conversion mode
+        #initialise the accelerometer and the magnetometer, which share one address
+        configure(reader.accAddress, {
+            LSM9DS0_CTRL_REG1_XM: 0b01100111,   #z,y,x axis enabled, continuos update,  100Hz data rate
+            LSM9DS0_CTRL_REG2_XM: 0b00100000,   #+/- 16G full scale
+            LSM9DS0_CTRL_REG5_XM: 0b11110000,   #Temp enable, M data rate = 50Hz
+            LSM9DS0_CTRL_REG6_XM: 0b01100000,   #+/-12gauss
+            LSM9DS0_CTRL_REG7_XM: 0b00000000,   #Continuous-conversion mode
+        }, AUTO_INCREMENT)
 
         #initialise the gyroscope
-        writeGRY(LSM9DS0_CTRL_REG1_G, 0b00001111)   #Normal power mode, all axes enabled
-        writeGRY(LSM9DS0_CTRL_REG4_G, 0b00110000)   #Continuos update, 2000 dps full scale
+        configure(reader.gyrAddress, {
+            LSM9DS0_CTRL_REG1_G: 0b00001111,    #Normal power mode, all axes enabled
+            LSM9DS0_CTRL_REG4_G: 0b00110000,    #Continuos update, 2000 dps full scale
+        }, AUTO_INCREMENT)
 
     else:       #For BerryIMUv2
-        #initialise the gyroscope
-        writeGRY(LSM9DS1_CTRL_REG4,0b00111000)      #z, y, x axis enabled for gyro
-        writeGRY(LSM9DS1_CTRL_REG1_G,0b10111000)    #Gyro ODR = 476Hz, 2000 dps
-        writeGRY(LSM9DS1_ORIENT_CFG_G,0b00111000)   #Swap orientation 
-
-        #initialise the accelerometer
-        writeACC(LSM9DS1_CTRL_REG5_XL,0b00111000)   #z, y, x axis enabled for accelerometer
-        writeACC(LSM9DS1_CTRL_REG6_XL,0b00101000)   #+/- 16g
+        #initialise the gyroscope and the accelerometer, which share one address
+        configure(reader.gyrAddress, {
+            LSM9DS1_CTRL_REG4: 0b00111000,      #z, y, x axis enabled for gyro
+            LSM9DS1_CTRL_REG1_G: 0b10111000,    #Gyro ODR = 476Hz, 2000 dps
+            LSM9DS1_ORIENT_CFG_G: 0b00111000,   #Swap orientation
+            LSM9DS1_CTRL_REG5_XL: 0b00111000,   #z, y, x axis enabled for accelerometer
+            LSM9DS1_CTRL_REG6_XL: 0b00101000,   #+/- 16g
+        }, 0)
 
         #initialise the magnetometer
-        writeMAG(LSM9DS1_CTRL_REG1_M, 0b10011100)   #Temp compensation enabled,Low power mode mode,80Hz ODR
-        writeMAG(LSM9DS1_CTRL_REG2_M, 0b01000000)   #+/-12gauss
-        writeMAG(LSM9DS1_CTRL_REG3_M, 0b00000000)   #continuos update
-        writeMAG(LSM9DS1_CTRL_REG4_M, 0b00000000)   #lower power mode for Z axis
+        configure(reader.magAddress, {
+            LSM9DS1_CTRL_REG1_M: 0b10011100,    #Temp compensation enabled,Low power mode mode,80Hz ODR
+            LSM9DS1_CTRL_REG2_M: 0b01000000,    #+/-12gauss
+            LSM9DS1_CTRL_REG3_M: 0b00000000,    #continuos update
+            LSM9DS1_CTRL_REG4_M: 0b00000000,    #lower power mode for Z axis
+        }, AUTO_INCREMENT)
 
 
 
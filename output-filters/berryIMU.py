@@ -21,7 +21,7 @@ import sys
 import time
 import math
 import IMU
-import datetime
+from sensors import clock
 import os
 # If the IMU is upside down (Skull logo facing up), change this value to 1
 IMU_UPSIDE_DOWN = 0	
@@ -39,7 +39,8 @@ MAG_MEDIANTABLESIZE = 9    	# Median filter table size for magnetometer. Higher
 
 
 ################# Compass Calibration values ############
-# Use calibrateBerryIMU.py to get calibration values 
+# Use calibrateBerryIMU.py to get calibration values, it saves them to a file loaded at startup.
+# The values below are only used when there is no such file.
 # Calibrating the compass isnt mandatory, however a calibrated 
 # compass will result in a more accurate heading value.
 
@@ -171,8 +172,6 @@ oldXAccRawValue = 0
 oldYAccRawValue = 0
 oldZAccRawValue = 0
 
-a = datetime.datetime.now()
-
 
 
 #Setup the tables for the mdeian filter. Fill them all with '1' soe we dont get devide by zero error 
@@ -192,31 +191,33 @@ mag_medianTable2Z = [1] * MAG_MEDIANTABLESIZE
 IMU.detectIMU()     #Detect if BerryIMUv1 or BerryIMUv2 is connected.
 IMU.initIMU()       #Initialise the accelerometer, gyroscope and compass
 
+#Compass calibration saved by calibrateBerryIMU.py, the magXmin..magZmax values above are only used without it
+magCalibration = IMU.loadCalibration()
+
+a = clock.monotonic_ns()
+
 
 while True:
 
     #Read the accelerometer,gyroscope and magnetometer values
-    ACCx = IMU.readACCx()
-    ACCy = IMU.readACCy()
-    ACCz = IMU.readACCz()
-    GYRx = IMU.readGYRx()
-    GYRy = IMU.readGYRy()
-    GYRz = IMU.readGYRz()
-    MAGx = IMU.readMAGx()
-    MAGy = IMU.readMAGy()
-    MAGz = IMU.readMAGz()
+    #Wait for new data instead of sleeping, so each loop handles exactly one new gyro sample
+    (ACCx, ACCy, ACCz), (GYRx, GYRy, GYRz), (MAGx, MAGy, MAGz) = IMU.readNew()
 
 
     #Apply compass calibration    
-    MAGx -= (magXmin + magXmax) /2 
-    MAGy -= (magYmin + magYmax) /2 
-    MAGz -= (magZmin + magZmax) /2 
+    if magCalibration is not None:
+        MAGx, MAGy, MAGz = magCalibration.correct([MAGx, MAGy, MAGz])
+    else:
+        MAGx -= (magXmin + magXmax) /2 
+        MAGy -= (magYmin + magYmax) /2 
+        MAGz -= (magZmin + magZmax) /2 
  
 
     ##Calculate loop Period(LP). How long between Gyro Reads
-    b = datetime.datetime.now() - a
-    a = datetime.datetime.now()
-    LP = b.microseconds/(1000000*1.0)
+    #Uses the monotonic time of the gyro read itself, so gaps longer than a second are measured correctly
+    b = IMU.gyrTime() - a
+    a = IMU.gyrTime()
+    LP = b/(1000000000*1.0)
     print "Loop Time | %5.2f|" % ( LP ),
 
 
@@ -412,7 +413,5 @@ while True:
     print ""  
 
 
-    #slow program down a bit, makes the output more readable
-    time.sleep(0.03)
 
 
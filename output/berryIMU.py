@@ -19,7 +19,8 @@
 import time
 import math
 import IMU
-import datetime
+from sensors import clock
+from sensors import scheduler
 import os
 
 # If the IMU is upside down (Skull logo facing up), change this value to 1
@@ -32,7 +33,8 @@ AA =  0.40      # Complementary filter constant
 
 
 ################# Compass Calibration values ############
-# Use calibrateBerryIMU.py to get calibration values 
+# Use calibrateBerryIMU.py to get calibration values, it saves them to a file loaded at startup.
+# The values below are only used when there is no such file.
 # Calibrating the compass isnt mandatory, however a calibrated 
 # compass will result in a more accurate heading value.
 
@@ -152,6 +154,9 @@ def kalmanFilterX ( accAngle, gyroRate, DT):
 IMU.detectIMU()     #Detect if BerryIMUv1 or BerryIMUv2 is connected.
 IMU.initIMU()       #Initialise the accelerometer, gyroscope and compass
 
+#Compass calibration saved by calibrateBerryIMU.py, the magXmin..magZmax values above are only used without it
+magCalibration = IMU.loadCalibration()
+
 gyroXangle = 0.0
 gyroYangle = 0.0
 gyroZangle = 0.0
@@ -160,33 +165,32 @@ CFangleY = 0.0
 kalmanX = 0.0
 kalmanY = 0.0
 
-a = datetime.datetime.now()
+a = clock.monotonic_ns()
+loopTimer = scheduler.Scheduler(1.03)
 
 while True:
 
 
     #Read the accelerometer,gyroscope and magnetometer values
-    ACCx = IMU.readACCx()
-    ACCy = IMU.readACCy()
-    ACCz = IMU.readACCz()
-    GYRx = IMU.readGYRx()
-    GYRy = IMU.readGYRy()
-    GYRz = IMU.readGYRz()
-    MAGx = IMU.readMAGx()
-    MAGy = IMU.readMAGy()
-    MAGz = IMU.readMAGz()
+    ACCx, ACCy, ACCz = IMU.readACC()
+    GYRx, GYRy, GYRz = IMU.readGYR()
+    MAGx, MAGy, MAGz = IMU.readMAG()
     
 
     #Apply compass calibration    
-    MAGx -= (magXmin + magXmax) /2 
-    MAGy -= (magYmin + magYmax) /2 
-    MAGz -= (magZmin + magZmax) /2 
+    if magCalibration is not None:
+        MAGx, MAGy, MAGz = magCalibration.correct([MAGx, MAGy, MAGz])
+    else:
+        MAGx -= (magXmin + magXmax) /2 
+        MAGy -= (magYmin + magYmax) /2 
+        MAGz -= (magZmin + magZmax) /2 
  
     
     ##Calculate loop Period(LP). How long between Gyro Reads
-    b = datetime.datetime.now() - a
-    a = datetime.datetime.now()
-    LP = b.microseconds/(1000000*1.0)
+    #Uses the monotonic time of the gyro read itself, so gaps longer than a second are measured correctly
+    b = IMU.gyrTime() - a
+    a = IMU.gyrTime()
+    LP = b/(1000000000*1.0)
     print "Loop Time %5.2f " % ( LP ),
 
 
@@ -302,7 +306,8 @@ while True:
     print ""  
 
 
-    #slow program down a bit, makes the output more readable
-    time.sleep(1.03)
+    #slow program down a bit, makes the output more readable.
+    #Waits for the next 1.03s tick rather than 1.03s after the work, so the period doesn't drift
+    loopTimer.wait()
 
 
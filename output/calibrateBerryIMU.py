@@ -2,81 +2,77 @@
 #   This program is used to calibrate the compass on a BerryIMUv1 or
 #   BerryIMUv2.
 #
-#   Start this program and rotate your BerryIMU in all directions. 
-#   You will see the maximum and minimum values change. 
-#   After about 30secs or when the values are not changing, press Ctrl-C.
-#   The program will printout some text which you then need to add to
-#   berryIMU.py or berryIMU-simple.py
+#   Start this program and rotate your BerryIMU in all directions.
+#   You will see how many directions have been covered so far.
+#   The program stops by itself once every direction has been covered and
+#   the calibration has stopped changing, then saves it to a file that
+#   berryIMU.py and berryIMU-simple.py load at startup.
+#   Ctrl-C stops early. An incomplete calibration is only saved with --force,
+#   and never replaces one that is already saved.
+#
+#   python calibrateBerryIMU.py [--force] [calibration file]
 
 
 import sys,signal,os
 import time
-import math
 
 import IMU
-import datetime
+from sensors import calibration
+
+
+MAX_TIME = 120          #Give up after this many seconds, even if the thresholds are not met
 
 
 def handle_ctrl_c(signal, frame):
-    print " "
-    print "magXmin = ",  magXmin
-    print "magYmin = ",  magYmin
-    print "magZmin = ",  magZmin
-    print "magXmax = ",  magXmax
-    print "magYmax = ",  magYmax
-    print "magZmax = ",  magZmax
-    sys.exit(130) # 130 is standard exit code for ctrl-c
+    global stopped
+    stopped = True
+
 
 
+force = "--force" in sys.argv[1:]
+arguments = [a for a in sys.argv[1:] if a != "--force"]
+path = arguments[0] if arguments else calibration.DEFAULT_PATH
 
 IMU.detectIMU()
 IMU.initIMU()
 
 #This will capture exit when using Ctrl-C
+stopped = False
 signal.signal(signal.SIGINT, handle_ctrl_c)
 
 
-a = datetime.datetime.now()
+#Samples go into a preallocated array, checked every 40 samples (0.5s at 80Hz)
+collector = calibration.Collector()
+start = time.time()
 
 
-#Preload the variables used to keep track of the minimum and maximum values
-magXmin = 32767
-magYmin = 32767
-magZmin = 32767
-magXmax = -32767
-magYmax = -32767
-magZmax = -32767
+while not stopped and not collector.complete() and not collector.full() and time.time() - start < MAX_TIME:
 
+    #Read every new magnetometer sample at the full data rate
+    collector.add(IMU.readNewMAG())
 
-    
-while True:
+    if collector.count % collector.interval == 0:
+        print(" samples  %i  coverage  %3i%%  converged  %s  ## magXmin  %i  magYmin  %i  magZmin  %i  magXmax  %i  magYmax  %i  magZmax %i  " %
+              ((collector.count, collector.coverage() * 100, collector.converged()) + tuple(collector.minimum) + tuple(collector.maximum)))
 
-    #Read magnetometer values
-    MAGx = IMU.readMAGx()
-    MAGy = IMU.readMAGy()
-    MAGz = IMU.readMAGz()
-    
-    
-    
-    if MAGx > magXmax:
-        magXmax = MAGx
-    if MAGy > magYmax:
-        magYmax = MAGy
-    if MAGz > magZmax:
-        magZmax = MAGz
 
-    if MAGx < magXmin:
-        magXmin = MAGx
-    if MAGy < magYmin:
-        magYmin = MAGy
-    if MAGz < magZmin:
-        magZmin = MAGz
+if not collector.complete():
+    print "Calibration incomplete, rotate the BerryIMU through more directions and run again for a better result"
+    if not force:
+        print "Not saved, --force saves an incomplete calibration"
+        sys.exit(130 if stopped else 1)
+    if IMU.loadCalibration(path) is not None:
+        print "Not saved, an incomplete calibration never replaces the one in", path
+        sys.exit(130 if stopped else 1)
 
-    print(" magXmin  %i  magYmin  %i  magZmin  %i  ## magXmax  %i  magYmax  %i  magZmax %i  " %(magXmin,magYmin,magZmin,magXmax,magYmax,magZmax))
-
-
-
-    #slow program down a bit, makes the output more readable
-    time.sleep(0.03)
+if collector.count == 0:
+    sys.exit(1)
 
+profile = collector.profile()
+IMU.saveCalibration(profile, path)
+print " "
+print "Saved compass calibration to", path
+print profile
 
+if stopped:
+    sys.exit(130) # 130 is standard exit code for ctrl-c